@@ -0,0 +1,266 @@
+import argparse
+import logging
+import random
+import sys
+import time
+
+from .         import stanza
+from .client import Client
+from .parser import Parser
+from .server import PresenceServer
+from .types  import *
+
+IDENTITY = 'bench.local'
+OTHER    = 'peer@remote'
+# other clients a received message is broadcast to
+RECIPIENTS = 4
+
+STREAM_OPEN = (
+    f"<stream:stream xmlns='jabber:client'"
+    f" xmlns:stream='http://etherx.jabber.org/streams'"
+    f" from='{OTHER}' to='{IDENTITY}' version='1.0'>"
+)
+
+# socket stand-in that only counts outgoing data
+class NullSocket(object):
+    def __init__(self):
+        super(NullSocket,self).__init__()
+        self.address = 'bench'
+        self.port    = 0
+        self.nbytes  = 0
+
+    def send_line(self, msg):
+        self.send(msg + '\n')
+
+    def send(self, msg):
+        self.send_bytes(msg.encode())
+
+    def send_bytes(self, bmsg):
+        self.nbytes += len(bmsg)
+
+    def cork(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# corpus generation
+def _words(rng, n):
+    vocab = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'presence', 'xmpp',
+             'stanza', 'stream', 'link-local', 'bonjour', 'avahi']
+    return ' '.join(rng.choice(vocab) for _ in range(n))
+
+def make_html(rng, htmlsize):
+    markup = []
+    size = 0
+    while size < htmlsize:
+        markup.append(f'<b>{_words(rng, 3)}</b><br/><i>{_words(rng, 4)}</i>')
+        size += len(markup[-1])
+    return ''.join(markup)
+
+def make_message(rng, htmlsize):
+    text = _words(rng, max(1, htmlsize // 8))
+    return (
+        f"<message from='{OTHER}' to='{IDENTITY}' type='chat'>"
+        f"<body>{text}</body>"
+        f"<html xmlns='http://www.w3.org/1999/xhtml'>"
+        f"<body>{make_html(rng, htmlsize)}</body></html></message>"
+    )
+
+def make_si_offer(rng, n):
+    return (
+        f"<iq type='set' from='{OTHER}' to='{IDENTITY}' id='si{n}'>"
+        f"<si xmlns='{Protocol.SI}' id='s{n}'"
+        f" profile='{Protocol.SI_TRANSFER}'>"
+        f"<file xmlns='{Protocol.SI_TRANSFER}' name='file{n}.bin'"
+        f" size='{rng.randint(1, 1 << 30)}'/>"
+        f"<feature xmlns='{Protocol.FEATURE_NEG}'>"
+        f"<x xmlns='jabber:x:data' type='form'>"
+        f"<field var='stream-method' type='list-single'>"
+        f"<option><value>{Protocol.BYTESTREAMS}</value></option>"
+        f"</field></x></feature></si></iq>"
+    )
+
+def make_bytestreams(rng, n):
+    hosts = ''.join(
+        f"<streamhost jid='{OTHER}' host='10.0.0.{i}' port='{7777 + i}'/>"
+        for i in range(rng.randint(1, 4))
+    )
+    return (
+        f"<iq type='set' from='{OTHER}' to='{IDENTITY}' id='bs{n}'>"
+        f"<query xmlns='{Protocol.BYTESTREAMS}' sid='s{n}' mode='tcp'>"
+        f"{hosts}</query></iq>"
+    )
+
+def make_oob_offer(rng, n):
+    return (
+        f"<message from='{OTHER}' to='{IDENTITY}'>"
+        f"<body>file{n}</body><x xmlns='jabber:x:oob'>"
+        f"<url type='file' size='{rng.randint(1, 1 << 30)}'>"
+        f"http://10.0.0.1:8080/file{n}.bin</url></x></message>"
+    )
+
+def make_corpus(count, htmlsizes, seed=0):
+    rng = random.Random(seed)
+    stanzas = []
+    for n in range(count):
+        r = rng.random()
+        if r < 0.8:
+            stanzas.append(make_message(rng, rng.choice(htmlsizes)))
+        elif r < 0.9:
+            stanzas.append(make_si_offer(rng, n))
+        elif r < 0.95:
+            stanzas.append(make_bytestreams(rng, n))
+        else:
+            stanzas.append(make_oob_offer(rng, n))
+    return [s.encode() for s in stanzas]
+
+def chunked(stanzas, chunksize):
+    data = b''.join(stanzas)
+    return [data[i:i+chunksize] for i in range(0, len(data), chunksize)]
+
+# benchmarks
+def bench_parser(chunks, logger):
+    parser = Parser(logger=logger, maxsize=0)
+    parser.process(STREAM_OPEN.encode())
+    list(parser.feed(b''))
+    nresults = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        for result in parser.feed(chunk):
+            nresults += 1
+    return nresults, time.perf_counter() - start
+
+# counts the blocks allocated while parsing: results are dropped as they
+# come, so those still allocated at each step were just made
+def alloc_parser(chunks, logger):
+    parser = Parser(logger=logger, maxsize=0)
+    parser.process(STREAM_OPEN.encode())
+    list(parser.feed(b''))
+    nresults = 0
+    blocks   = 0
+    for chunk in chunks:
+        before = sys.getallocatedblocks()
+        for result in parser.feed(chunk):
+            blocks += sys.getallocatedblocks() - before
+            nresults += 1
+            del result
+            before = sys.getallocatedblocks()
+        blocks += max(sys.getallocatedblocks() - before, 0)
+    return nresults, blocks
+
+def make_client(logger, other=OTHER):
+    client = Client(
+        cs=NullSocket(), logger=logger,
+        args={'name': IDENTITY, 'other': other}
+    )
+    client.stream_is_open = True
+    return client
+
+# received messages are broadcast by the server to the other clients
+def bench_handle_message(messages, logger):
+    server = PresenceServer(logger=logger)
+    client = make_client(logger)
+    client.broadcast_func = server._broadcast
+    server.clients.add(client)
+    for n in range(RECIPIENTS):
+        server.clients.add(make_client(logger, f'peer{n}@remote'))
+    try:
+        start = time.perf_counter()
+        for message in messages:
+            client.handle_message(message)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.runner.shutdown()
+        server.transfers.shutdown()
+    return sum(ct.cs.nbytes for ct in server.clients), elapsed
+
+def bench_send_message(htmls, logger):
+    client = make_client(logger)
+    start = time.perf_counter()
+    for html in htmls:
+        client.send_message(
+            Message(html=html, ascii='', identity=IDENTITY, other=OTHER)
+        )
+    return client.cs.nbytes, time.perf_counter() - start
+
+def bench_stanza(htmls, logger):
+    nbytes = 0
+    start = time.perf_counter()
+    for html in htmls:
+        nbytes += len(
+            stanza.MESSAGE_START.render(identity=IDENTITY, other=OTHER)
+            + stanza.MESSAGE_PAYLOAD.render(text='', html=html)
+        )
+    return nbytes, time.perf_counter() - start
+
+def _report(name, count, nbytes, elapsed, extra=''):
+    rate  = count / elapsed if elapsed else float('inf')
+    brate = nbytes / elapsed / (1 << 20) if elapsed else float('inf')
+    print(f'{name:<16} {count:>8} stanzas {elapsed:8.3f}s'
+          f' {rate:>12.0f} stanzas/s {brate:>9.2f} MiB/s{extra}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m presence.bench',
+        description='stanza throughput benchmarks'
+    )
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help='number of stanzas (default: 20000)')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[16, 256, 4096],
+                        help='html body sizes in bytes (default: 16 256 4096)')
+    parser.add_argument('-c', '--chunksize', type=int, default=16384,
+                        help='bytes per parser feed (default: 16384)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs per benchmark, best is reported'
+                        ' (default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='corpus random seed (default: 0)')
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger('presence.bench')
+    logger.setLevel(logging.WARNING)
+
+    stanzas = make_corpus(args.count, args.sizes, seed=args.seed)
+    chunks  = chunked(stanzas, args.chunksize)
+    nbytes  = sum(len(s) for s in stanzas)
+    print(f'corpus: {len(stanzas)} stanzas, {nbytes} bytes,'
+          f' {len(chunks)} chunks of {args.chunksize} bytes')
+
+    count, elapsed = min(
+        (bench_parser(chunks, logger) for _ in range(args.repeat)),
+        key=lambda r: r[1]
+    )
+    _report('parser', count, nbytes, elapsed)
+
+    count, blocks = alloc_parser(chunks, logger)
+    print(f'{"parser memory":<16} {blocks / count:8.1f} blocks/stanza'
+          ' allocated')
+
+    # messages as produced by the parser, plain text so nothing is a command
+    p = Parser(logger=logger, maxsize=0)
+    p.process(STREAM_OPEN.encode())
+    messages = [
+        r.data for r in p.feed(b''.join(stanzas))
+        if r.type == ResultType.MESSAGE
+    ]
+    # outgoing html as composed by commands
+    rng = random.Random(args.seed)
+    htmls = [make_html(rng, rng.choice(args.sizes)) for _ in messages]
+    for name, func, data in (
+            ('handle_message', bench_handle_message, messages),
+            ('send_message',   bench_send_message,   htmls),
+            ('stanza',         bench_stanza,         htmls)):
+        out, elapsed = min(
+            (func(data, logger) for _ in range(args.repeat)),
+            key=lambda r: r[1]
+        )
+        _report(name, len(data), out, elapsed,
+                f' ({1e6 * elapsed / len(data):.1f} us/message)')
+
+if __name__ == '__main__':
+    main()
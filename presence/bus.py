@@ -0,0 +1,155 @@
+import json
+import logging
+import os
+import socket
+import threading
+
+# relays messages between worker processes over a unix domain socket
+class MessageBus(object):
+    def __init__(self, path, logger=logging.getLogger()):
+        super(MessageBus,self).__init__()
+        self.path   = path
+        self.logger = logger
+
+        self.serversocket = None
+        self.connections  = []
+        # connection -> lock, lines from several relay threads are
+        # written whole
+        self.writelocks   = {}
+        self.lock = threading.Lock()
+
+    # public interface
+    def listen(self):
+        if self.serversocket:
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.logger.debug(f'Message bus listening on {self.path}')
+        self.serversocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.serversocket.bind(self.path)
+        self.serversocket.listen(5)
+
+    def start(self):
+        self.listen()
+        t = threading.Thread(target=self._accept_loop, name='bus', daemon=True)
+        t.start()
+
+    def cleanup(self):
+        with self.lock:
+            connections = self.connections[:]
+        for conn in connections:
+            conn.close()
+        if self.serversocket:
+            self.serversocket.close()
+            self.serversocket = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # internal functions
+    def _accept_loop(self):
+        while True:
+            try:
+                (conn, _) = self.serversocket.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections.append(conn)
+                self.writelocks[conn] = threading.Lock()
+            t = threading.Thread(
+                target=self._relay_loop, args=(conn,), daemon=True
+            )
+            t.start()
+
+    def _relay_loop(self, conn):
+        worker = None
+        try:
+            for line in conn.makefile('rb'):
+                if worker is None:
+                    worker = _worker(line)
+                self._relay(conn, line)
+        except OSError:
+            pass
+        with self.lock:
+            self.connections.remove(conn)
+            del self.writelocks[conn]
+        conn.close()
+        if worker is not None:
+            # the users of the worker are gone with it
+            self.logger.debug(f'Worker {worker} left the message bus')
+            msg = {'type': 'gone', 'worker': worker}
+            self._relay(conn, (json.dumps(msg) + '\n').encode())
+
+    # writes line to all connections except conn
+    def _relay(self, conn, line):
+        with self.lock:
+            others = [
+                (other, self.writelocks[other]) for other in self.connections
+                if other is not conn
+            ]
+        for other, lock in others:
+            try:
+                with lock:
+                    other.sendall(line)
+            except OSError as e:
+                self.logger.debug(f'Bus write failed: {e}')
+
+# worker id of a bus message, None if it has none
+def _worker(line):
+    try:
+        return json.loads(line).get('worker', None)
+    except (ValueError, AttributeError):
+        return None
+
+# connection of a single worker process to the message bus
+class BusClient(object):
+    def __init__(self, path, worker, logger=logging.getLogger()):
+        super(BusClient,self).__init__()
+        self.path   = path
+        self.worker = worker
+        self.logger = logger
+
+        self.sock    = None
+        self.lock    = threading.Lock()
+        self.handler = None
+
+    # public interface
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        t = threading.Thread(target=self._read_loop, name='bus', daemon=True)
+        t.start()
+
+    def publish(self, msg):
+        if not self.sock:
+            return
+        msg = dict(msg, worker=self.worker)
+        data = (json.dumps(msg) + '\n').encode()
+        try:
+            with self.lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            self.logger.error(f'Publishing to message bus failed: {e}')
+
+    def close(self):
+        if self.sock:
+            # the reader's file keeps the socket open, end the connection
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    # internal functions
+    def _read_loop(self):
+        try:
+            for line in self.sock.makefile('rb'):
+                try:
+                    msg = json.loads(line)
+                except ValueError as e:
+                    self.logger.error(f'Skipping bad bus message: {e}')
+                    continue
+                if self.handler:
+                    self.handler(msg)
+        except OSError as e:
+            self.logger.debug(f'Message bus connection closed: {e}')
@@ -1,43 +1,108 @@
+import asyncio
 import html
 import logging
 import re
 import os
 import socket
 import threading
+import time
 
-import xml.etree.ElementTree
+import xml.parsers.expat
 
+from .         import stanza
+from .commands import CommandRegistry
+from .listing  import DirectoryIndex
+from .metrics  import Metrics
 from .parser import Parser
-from .sock   import ClientSocket
+from .sock   import AsyncClientSocket, ClientSocket, Overflow
 from .types  import *
 
-class ClientThread(threading.Thread):
+# protocol logic shared by the threaded and the asyncio client
+class Client(object):
     @staticmethod
-    def make_command(func=None, helptext='', greedy=False):
+    def make_command(func=None, helptext='', greedy=False, inline=False,
+                     timeout=None, concurrency=None, cache_ttl=None):
         if not func:
             func = lambda client, message: True
-        d = { 'func': func, 'help': helptext, 'greedy': greedy }
+        d = {
+            'func': func, 'help': helptext, 'greedy': greedy,
+            # inline commands are cheap and bypass the command runner
+            'inline': inline,
+            # seconds until the user is notified, the command is not
+            # stopped and keeps its pool slot; maximum parallel runs
+            'timeout': timeout, 'concurrency': concurrency,
+            # seconds the output is served from the server's command cache
+            'cache_ttl': cache_ttl,
+        }
         return type('Command', (object,), d)
 
-    def __init__(self, sock, address, logger=logging.getLogger(), args={}):
-        super(ClientThread,self).__init__()
+    def __init__(self, cs=None, logger=logging.getLogger(), args={}):
+        super(Client,self).__init__()
         self.logger = logger
-        self.cs     = ClientSocket(sock,address,logger=self.logger)
+        self.cs     = cs
         self.args   = dict(args)
         
         self.identity    = self.args.get('name',  socket.gethostname()+'.local')
         self.other       = self.args.get('other', None)
         self.downloaddir = self.args.get('downloaddir', None)
+        # passed to Transfer.retrieve
+        self.transfer_options = {
+            'timeout': self.args.get('transfertimeout', 30),
+            'stagger': self.args.get('streamhoststagger', 0.25),
+            'segments': self.args.get('downloadsegments', 4),
+        }
         self.commands    = self.args.get('commands', {})
-        self.commands.update(self._default_commands())
+        if not isinstance(self.commands, CommandRegistry):
+            self.commands = self.build_commands(
+                self.commands, self.args.get('aliases', {}),
+                prefixlen=self.args.get('prefixlen', 2)
+            )
         
-        self.parser  = Parser(logger=self.logger)
-        self.stopped = threading.Event()
+        # server-wide metrics, collection is off unless the server enables it
+        self.metrics = self.args.get('metrics', None) or Metrics(enabled=False)
+        self.transfers_active = self.metrics.gauge(
+            'presence_transfers_active', 'file transfers in progress'
+        )
+
+        self.parser  = Parser(
+            logger=self.logger,
+            maxsize=self.args.get('maxstanzasize', 1<<20),
+            metrics=self.metrics
+        )
+        # dispatch results directly from the parser callbacks
+        for resulttype in range(len(ResultTypeStr)):
+            self.parser.register(resulttype, self.process_result)
         self.cleanup_func   = None
         self.broadcast_func = None
+        self.direct_func    = None
+        self.identify_func  = None
+        # CommandRunner of the server, commands run inline if not set
+        self.runner         = None
+        # CommandCache of the server
+        self.cache          = None
+        # payloads sent by the current thread while running a cached command
+        self.capture        = threading.local()
+        # TransferManager of the server, transfers block the client if
+        # not set
+        self.transfers      = None
+        # download directory index, shared by the server's clients
+        self.listing        = DirectoryIndex(logger=self.logger)
+
+        # set by the server's client registry
+        self.conn_id        = None
+        self.registered_jid = None
 
         self.stream_is_open = False
         
+    # built-in commands extended by commands, for sharing between clients
+    @classmethod
+    def build_commands(cls, commands={}, aliases={}, prefixlen=2):
+        table = cls._default_commands()
+        table.update(commands)
+        default_aliases = { '?': 'help' }
+        default_aliases.update(aliases)
+        return CommandRegistry(table, default_aliases, prefixlen=prefixlen)
+
     # public interface
     def send_ascii(self,ascii):
         asciitext = html.escape(ascii.strip())
@@ -60,15 +125,26 @@ class ClientThread(threading.Thread):
         self.send_message(message)
 
     def is_empty_message(self,message):
-        ascii = message.ascii.strip()
-        html  = ''.join(
-            xml.etree.ElementTree.fromstring(
-                f'<p>{message.html}</p>'
-            ).itertext()
-        ).strip()
-        if len(ascii) or len(html):
-            return False
-        return True
+        return message.is_empty
+
+    @staticmethod
+    def render_payload(message):
+        # everything after the envelope, identical for all recipients
+        ascii = message.ascii
+        if not ascii:
+            ascii = message.text
+        if len(ascii):
+            ascii = '\n' + ascii
+        return stanza.MESSAGE_PAYLOAD.render(text=ascii, html=message.html)
+
+    def send_payload(self, payload):
+        payloads = getattr(self.capture, 'payloads', None)
+        if payloads is not None:
+            payloads.append(payload)
+        self.cs.send_bytes(
+            stanza.MESSAGE_START.render(identity=self.identity, other=self.other)
+            + payload
+        )
 
     def send_message(self,message):
         if message.identity != self.identity:
@@ -81,23 +157,7 @@ class ClientThread(threading.Thread):
                 f'Message recipients do not match:'
                 f' message "{message.other}", client "{self.other}"'
             )
-        if not message.ascii:
-            message.ascii = re.sub(r'<br/?>', '\n', message.html)
-            message.ascii = ''.join(
-                xml.etree.ElementTree.fromstring(
-                    f'<p>{message.ascii}</p>'
-                ).itertext()
-            ).strip()
-        if len(message.ascii):
-            message.ascii = html.escape(message.ascii)
-            message.ascii = '\n' + message.ascii
-        self.cs.send_line(
-            f"<message from='{self.identity}' to='{self.other}' type='chat'>"
-            f"<body>{message.ascii}</body>"
-            f"<html xmlns='http://www.w3.org/1999/xhtml'>"
-            f"<body>{message.html}</body>"
-            f"</html></message>"
-        )
+        self.send_payload(self.render_payload(message))
 
     def echo(self, message):
         identity = message.identity
@@ -117,58 +177,112 @@ class ClientThread(threading.Thread):
             f'Welcome at <b>{self.identity}</b><br/>{self._command_text()}'
         )
 
-    def ls_downloaddir(self):
+    # ls [-S|-t] [-r] [pattern] [page]
+    def ls_downloaddir(self, message=None):
         d = self.downloaddir
         if not d:
             self.send_html('Downloads disabled')
             return
-        if not os.path.exists(d):
+        sort, reverse, pattern, page = 'name', False, None, 1
+        words = message.ascii.split()[1:] if message else []
+        for word in words:
+            if word == '-S':
+                sort = 'size'
+            elif word == '-t':
+                sort = 'date'
+            elif word == '-r':
+                reverse = True
+            elif word.isdigit():
+                page = max(1, int(word))
+            else:
+                pattern = word
+        try:
+            entries = self.listing.entries(d, sort, reverse, pattern)
+        except FileNotFoundError:
             self.send_html('Download directory does not exist')
             return
+        except OSError as e:
+            self.logger.error(f'Listing {d} failed: {e}')
+            self.send_html('Download directory cannot be read')
+            return
+
+        pagesize = self.args.get('lspagesize', 50)
+        pages = max(1, -(-len(entries) // pagesize))
+        page  = min(page, pages)
         fill = ' '*4
-        msg = f'Contents of <b>{d}</b><br/>'
-        entries = os.listdir(d)
-        for entry in entries:
-            stat = os.stat(os.path.join(d,entry))
-            printname = entry
-            if os.path.isdir(entry):
-                printname = f'[{printname}]'
-            elif os.path.isfile(entry):
-                printname = str(printname)
-            msg += fill + (f"{printname}\n")
+        lines = [f'Contents of <b>{html.escape(d)}</b><br/>']
+        for entry in entries[(page-1)*pagesize:page*pagesize]:
+            if entry.is_dir:
+                lines.append(f'{fill}[{html.escape(entry.name)}]<br/>')
+            else:
+                lines.append(
+                    f'{fill}{html.escape(entry.name)} {entry.size}<br/>'
+                )
         if not len(entries):
-            msg += 'No files found'
-
-        self.send_html(msg)
-
+            lines.append('No files found')
+        elif pages > 1:
+            lines.append(f'page {page} of {pages} ({len(entries)} entries)')
+        if page < pages:
+            more = ' '.join(
+                ['ls'] + [w for w in words if not w.isdigit()] + [str(page+1)]
+            )
+            lines.append(f', <b>{html.escape(more)}</b> for more')
+        self.send_html(''.join(lines))
 
     # internal functions
-    def _default_commands(self):
+    @classmethod
+    def _default_commands(cls):
         return {
-            'echo': self.make_command(
+            'echo': cls.make_command(
                 func=staticmethod(lambda client, message: client.echo(message)),
                 helptext="echo text",
-                greedy=True),
-            'help': self.make_command(
+                greedy=True, inline=True),
+            'help': cls.make_command(
                 func=staticmethod(lambda client, message: client.help()),
-                helptext="print this help"),
-            'hello': self.make_command(
+                helptext="print this help", inline=True),
+            'hello': cls.make_command(
                 func=staticmethod(lambda client, message: client.hello()),
-                helptext="print a hello message"),
-            'vars': self.make_command(
+                helptext="print a hello message", inline=True),
+            'vars': cls.make_command(
                 func=staticmethod(lambda client, message: client.vars()),
-                helptext="print variables"),
-            'ls': self.make_command(
+                helptext="print variables", inline=True),
+            'ls': cls.make_command(
                 func=staticmethod(lambda client, message:
-                                  client.ls_downloaddir()),
-                helptext="list contents of download directory"),
+                                  client.ls_downloaddir(message)),
+                helptext="list contents of download directory,"
+                " [-S|-t] [-r] [pattern] [page]",
+                greedy=True),
             }
     
+    def _run_cached(self, command, key, message):
+        self.capture.payloads = []
+        try:
+            command.func(self,message)
+        except:
+            for client in self.cache.discard(key):
+                client.send_html(f'<b>{key[0]}</b>: failed')
+            raise
+        finally:
+            payloads = self.capture.payloads
+            self.capture.payloads = None
+        self.cache.store(key, payloads, command.cache_ttl)
+
+    # measures the time from the request to the end of the command,
+    # including the wait for a free runner thread
+    def _timed(self, name, func):
+        histogram = self.metrics.histogram(
+            'presence_command_seconds', 'command latency', command=name
+        )
+        start = time.perf_counter()
+        def timed(client, message):
+            try:
+                func(client, message)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return timed
+
     def _command_text(self):
-        ret = '<b>commands:</b><br/>'
-        for k, v in sorted(self.commands.items()):
-            ret += f'  {k} - {v.help}<br/>'
-        return ret
+        return self.commands.helptext
 
     def _var_text(self):
         return ('<b>variables:</b><br/>'
@@ -177,17 +291,32 @@ class ClientThread(threading.Thread):
                 f'  downloaddir - {self.downloaddir}<br/>')
         return ret
         
-    def _send_si_result(self, iq_id):
-        self.cs.send_line(
-            f"<iq type='result' from='{self.identity}' to='{self.other}'"
-            f" id='{ip_id}'>"
-            f"<si xmlns='http://jabber.org/protocol/si'>"
-            f"<feature xmlns='{Protocol.FEATURE_NEG}'>"
-            f"<x xmlns='jabber:x:data' type='submit'>"
-            f"<field var='stream-method'>"
-            f"<value>{Protocol.BYTESTREAMS}</value>"
-            f"</field></x></feature></si></iq>"
+    def _send_si_result(self, fn):
+        offset = self._si_offset(fn)
+        if offset:
+            self.logger.info(f'Resuming {fn.filename} at {offset} bytes')
+            self.cs.send_bytes(stanza.SI_RESULT_RANGE.render(
+                identity=self.identity, other=self.other, id=fn.iq_id,
+                offset=offset
+            ))
+            return
+        self.cs.send_bytes(stanza.SI_RESULT.render(
+            identity=self.identity, other=self.other, id=fn.iq_id
+        ))
+
+    # bytes of an offered file kept from an earlier attempt, if the sender
+    # can skip them
+    def _si_offset(self, fn):
+        if not fn.ranges or not self.downloaddir or not fn.filename:
+            return 0
+        name = os.path.basename(fn.filename)
+        if name in ('', '.', '..') or not str(fn.filesize).isdigit():
+            return 0
+        partial = si_partial(
+            os.path.join(self.downloaddir, name), fn.other, fn.filename,
+            int(fn.filesize), self.logger
         )
+        return partial.resumable()
 
     # handlers for parser results
     def handle_message(self, message):
@@ -199,17 +328,47 @@ class ClientThread(threading.Thread):
         words = message.ascii.strip().split()
         command = None
         if len(words):
-            if words[0].strip() in self.commands.keys():
-                command = words[0].strip()
+            # abbreviations only stand alone, so chat like "us too" is
+            # not taken for a command
+            command = self.commands.lookup(
+                words[0], abbreviate=len(words) == 1
+            )
         if command:        
             if not self.commands[command].greedy and \
                     len(words) > 1:
                 return
-            self.commands[command].func(self,message)
+            self.run_command(command,message)
+        elif len(words) and words[0].startswith('@') and len(words[0]) > 1:
+            # direct message to a single user
+            if self.direct_func:
+                text = message.ascii.strip()[len(words[0]):].strip()
+                self.direct_func(self,words[0][1:],text)
         else:
             if self.broadcast_func:
                 self.broadcast_func(self,message)
 
+    def run_command(self, name, message):
+        command = self.commands[name]
+        func = command.func
+        key  = None
+        if command.cache_ttl and self.cache:
+            key = (name, tuple(message.ascii.split()[1:]))
+            if not self.cache.acquire(key, self):
+                return
+            func = lambda client, message: \
+                client._run_cached(command, key, message)
+        if self.metrics.enabled:
+            func = self._timed(name, func)
+        if command.inline or not self.runner:
+            func(self,message)
+        elif not self.runner.submit(self,name,command,message,func=func):
+            self.logger.info(f'Command runner busy, rejecting "{name}"')
+            waiting = [self]
+            if key:
+                waiting += self.cache.discard(key)
+            for client in waiting:
+                client.send_html(f'<b>{name}</b>: busy, try again later')
+
     def handle_transfer(self, transfer):
         self.logger.debug("Entering client.handle_transfer")
         if not self.downloaddir:
@@ -218,7 +377,33 @@ class ClientThread(threading.Thread):
             )
             transfer.reject(self.cs)
             return
-        status = transfer.retrieve(self.cs, self.downloaddir)
+        if self.transfers is None:
+            self.retrieve_transfer(transfer)
+            return
+        job = self.transfers.submit(self, transfer)
+        if not job:
+            self.logger.info("Rejecting file transfer, transfer queue full")
+            transfer.reject(self.cs)
+            self.send_html('Too many file transfers, try again later')
+            return
+        self.send_html(
+            f'Receiving <b>{html.escape(job.name)}</b> as transfer {job.id}'
+        )
+
+    # blocks until the file is retrieved
+    def retrieve_transfer(self, transfer):
+        self.transfers_active.inc()
+        try:
+            status = transfer.retrieve(
+                self.cs, self.downloaddir, self.transfer_options
+            )
+        finally:
+            self.transfers_active.dec()
+        self.metrics.counter(
+            'presence_transfers_total', 'finished file transfers',
+            status='ok' if status else 'failed'
+        ).inc()
+        return status
 
     def handle_stream_open(self,stream):
         self.logger.debug("Entering client.handle_stream_open")
@@ -241,18 +426,18 @@ class ClientThread(threading.Thread):
                 f' remote "{stream.other}"'
             )
              
-        self.cs.send_line(
-            f"<stream:stream xmlns='jabber:client'"
-            f" xmlns:stream='http://etherx.jabber.org/streams'"
-            f" from='{self.identity}' to='{self.other}' version='1.0'>"
-        )
+        self.cs.send_bytes(stanza.STREAM_OPEN.render(
+            identity=self.identity, other=self.other
+        ))
         self.stream_is_open = True
+        if self.identify_func:
+            self.identify_func(self)
 
     def handle_feature_neg(self, fn):
         self.logger.debug("Entering client.handle_feature_neg")
         for v in fn.option_values:
             if v == Protocol.BYTESTREAMS:
-                self._send_si_result(fn.iq_id)
+                self._send_si_result(fn)
                 break
             else:
                 self.logger.warning(f'Unhandled option value "{v}"')
@@ -262,10 +447,20 @@ class ClientThread(threading.Thread):
         if not self.stream_is_open:
             self.logger.error("Stream is not open, not closing")
             return
-        self.cs.send_line("</stream:stream>")
+        self.cs.send_bytes(stanza.STREAM_CLOSE)
         self.stream_is_open = False
 
+    def handle_stream_error(self, condition):
+        self.logger.debug("Entering client.handle_stream_error")
+        if self.stream_is_open:
+            self.cs.send_bytes(stanza.STREAM_ERROR.render(condition=condition))
+        self.stop()
+
     # Functions related to threading/event loop
+    # ends the connection, the engines close it from their own context
+    def stop(self):
+        pass
+
     def process_result(self, result):
         self.logger.debug("Entering client.process_result")
         if result.type   == ResultType.STREAM_OPEN:
@@ -283,6 +478,9 @@ class ClientThread(threading.Thread):
         elif result.type == ResultType.FEATURE_NEG:
             self.logger.debug("Handling feature negotiation")
             self.handle_feature_neg(result.data)
+        elif result.type == ResultType.STREAM_ERROR:
+            self.logger.debug("Handling stream error")
+            self.handle_stream_error(result.data)
         else:
             self.logger.warning("Unknown result type")
 
@@ -292,16 +490,43 @@ class ClientThread(threading.Thread):
             self.process_result(result)
             result = self.parser.next()
             
+    def _shutdown(self):
+        if self.stream_is_open:
+            self.close_stream()
+        self.cs.close()
+        if self.cleanup_func:
+            self.cleanup_func(self)
+
+# one thread per connection, polling the socket
+class ClientThread(Client, threading.Thread):
+    def __init__(self, sock, address, logger=logging.getLogger(), args={}):
+        threading.Thread.__init__(self)
+        Client.__init__(
+            self, cs=ClientSocket(
+                sock, address, logger=logger,
+                queuesize=args.get('queuesize', 256),
+                overflow=args.get('overflow', Overflow.DROP_OLDEST),
+                readsize=args.get('readsize', 16384),
+                metrics=args.get('metrics', None),
+            ),
+            logger=logger, args=args
+        )
+        self.stopped = threading.Event()
+
     def receive(self):
-        chunk = ''
         try:
-            while self.parser.process(chunk):
-                chunk = self.cs.recv()
+            chunk = self.cs.recv()
         except socket.timeout as e:
             return False
         except socket.error as e:
             self.logger.debug(f'socket.error {str(e)}')
             return False
+        # replies to one chunk are written together
+        self.cs.cork()
+        try:
+            self.parser.process(chunk)
+        finally:
+            self.cs.flush()
         return True
 
     def run(self):
@@ -312,13 +537,88 @@ class ClientThread(threading.Thread):
                 self.process()
         except RuntimeError:
             pass
-        if self.stream_is_open:
-            self.close_stream()
-        self.cs.close()
-        if self.cleanup_func:
-            self.cleanup_func(self)
+        except xml.parsers.expat.ExpatError as e:
+            self.logger.error(f'Parse error: {e}')
+        finally:
+            # also when a handler failed, so the client is unregistered
+            self._shutdown()
+
+    # without a transfer manager, retrieving files blocks this thread;
+    # the replies held for the current chunk are released first, so the
+    # streamhost-used iq the sender waits for goes out during the transfer
+    def handle_transfer(self, transfer):
+        if self.transfers is None:
+            self.cs.flush()
+        super(ClientThread,self).handle_transfer(transfer)
 
     def stop(self):
         self.logger.debug("Entering client.stop")
         self.stopped.set()
 
+# asyncio protocol, driven by the event loop without polling
+class AsyncClient(Client, asyncio.BufferedProtocol):
+    def __init__(self, loop, logger=logging.getLogger(), args={}):
+        Client.__init__(self, logger=logger, args=args)
+        self.loop = loop
+        self.startup_func = None
+        self.closed = False
+
+    # asyncio.BufferedProtocol callbacks
+    def connection_made(self, transport):
+        self.cs = AsyncClientSocket(
+            transport, self.loop, logger=self.logger,
+            queuesize=self.args.get('queuesize', 256),
+            overflow=self.args.get('overflow', Overflow.DROP_OLDEST),
+            readsize=self.args.get('readsize', 16384),
+            metrics=self.metrics,
+        )
+        self.logger.info(f"Starting client {self.cs.address}:{self.cs.port}")
+        if self.startup_func:
+            self.startup_func(self)
+
+    def pause_writing(self):
+        self.cs.pause_writing()
+
+    def resume_writing(self):
+        self.cs.resume_writing()
+
+    def get_buffer(self, sizehint):
+        return self.cs.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        # replies to one chunk are written together
+        self.cs.cork()
+        try:
+            self.parser.process(self.cs.buffer_updated(nbytes))
+        except xml.parsers.expat.ExpatError as e:
+            self.logger.error(f'Parse error: {e}')
+            self.stop()
+            return
+        finally:
+            self.cs.flush()
+        self.process()
+
+    def connection_lost(self, exc):
+        self.logger.debug("Entering client.connection_lost")
+        if self.closed:
+            return
+        # the peer is gone, nothing can be sent anymore
+        self.stream_is_open = False
+        self.stop()
+
+    # without a transfer manager, retrieving files blocks; hand it off to
+    # the default executor
+    def handle_transfer(self, transfer):
+        if self.transfers is not None:
+            super(AsyncClient,self).handle_transfer(transfer)
+            return
+        self.loop.run_in_executor(
+            None, super(AsyncClient,self).handle_transfer, transfer
+        )
+
+    def stop(self):
+        self.logger.debug("Entering client.stop")
+        if self.closed:
+            return
+        self.closed = True
+        self._shutdown()
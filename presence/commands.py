@@ -0,0 +1,187 @@
+import bisect
+import collections
+import concurrent.futures
+import html
+import logging
+import threading
+import time
+import types
+
+# runs client commands on a bounded thread pool
+class CommandRunner(object):
+    def __init__(self, poolsize=4, logger=logging.getLogger()):
+        super(CommandRunner,self).__init__()
+        self.poolsize = poolsize
+        self.logger   = logger
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=poolsize, thread_name_prefix='command'
+        )
+        self.lock    = threading.Lock()
+        self.active  = 0
+        self.running = {}
+
+    # returns False if the pool or the command's concurrency limit is
+    # exhausted
+    def submit(self, client, name, command, message, func=None):
+        limit = getattr(command, 'concurrency', None)
+        with self.lock:
+            if self.active >= self.poolsize:
+                return False
+            if limit and self.running.get(name, 0) >= limit:
+                return False
+            self.active += 1
+            self.running[name] = self.running.get(name, 0) + 1
+        future = self.executor.submit(func or command.func, client, message)
+        timer = None
+        timeout = getattr(command, 'timeout', None)
+        if timeout:
+            timer = threading.Timer(
+                timeout, self._timed_out, args=(client, name, future)
+            )
+            timer.daemon = True
+            timer.start()
+        future.add_done_callback(
+            lambda f: self._finished(client, name, f, timer)
+        )
+        return True
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # internal functions
+    def _timed_out(self, client, name, future):
+        if future.done():
+            return
+        # threads cannot be interrupted, the slot stays taken until the
+        # command returns
+        self.logger.warning(f'Command "{name}" timed out')
+        client.send_html(f'<b>{name}</b>: timed out')
+
+    def _finished(self, client, name, future, timer):
+        if timer:
+            timer.cancel()
+        with self.lock:
+            self.active -= 1
+            self.running[name] -= 1
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e:
+            self.logger.error(f'Command "{name}" failed: {e!r}')
+
+# rendered command output shared by all clients of a server, with TTL
+# and LRU eviction
+class CommandCache(object):
+    def __init__(self, maxsize=128, logger=logging.getLogger()):
+        super(CommandCache,self).__init__()
+        self.maxsize = maxsize
+        self.logger  = logger
+        self.lock    = threading.Lock()
+        # key -> (expiry time, payloads)
+        self.entries = collections.OrderedDict()
+        # key -> clients waiting for a command that is already running
+        self.waiting = {}
+
+    # returns True if the caller has to run the command and store its
+    # output, otherwise the client is served from the cache
+    def acquire(self, key, client):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                payloads = entry[1]
+            elif key in self.waiting:
+                self.waiting[key].append(client)
+                return False
+            else:
+                self.entries.pop(key, None)
+                self.waiting[key] = []
+                return True
+        self.logger.debug(f'Command cache hit for {key}')
+        self._replay(client, payloads)
+        return False
+
+    def store(self, key, payloads, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, payloads)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            waiting = self.waiting.pop(key, [])
+        for client in waiting:
+            self._replay(client, payloads)
+
+    # gives up on a running command, returns the waiting clients
+    def discard(self, key):
+        with self.lock:
+            return self.waiting.pop(key, [])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # internal functions
+    def _replay(self, client, payloads):
+        for payload in payloads:
+            client.send_payload(payload)
+
+# immutable command table with aliases and unique prefix matching,
+# built once and shared by all clients
+class CommandRegistry(object):
+    def __init__(self, commands={}, aliases={}, prefixlen=2):
+        super(CommandRegistry,self).__init__()
+        self.commands  = types.MappingProxyType(dict(commands))
+        self.aliases   = types.MappingProxyType({
+            alias: name for alias, name in aliases.items() if name in commands
+        })
+        # minimum length of an abbreviation, 0 disables prefix matching
+        self.prefixlen = prefixlen
+        self.names     = tuple(sorted(self.commands))
+
+        # help text is rendered once, help strings are plain text
+        byname = {}
+        for alias, name in sorted(self.aliases.items()):
+            byname.setdefault(name, []).append(alias)
+        lines = ['<b>commands:</b><br/>']
+        for name in self.names:
+            aliases = ''
+            if name in byname:
+                aliases = f" ({', '.join(byname[name])})"
+            helptext = self.commands[name].help
+            lines.append(html.escape(
+                f'  {name}{aliases} - {helptext}', quote=False
+            ) + '<br/>')
+        self.helptext = ''.join(lines)
+
+    def __contains__(self, name):
+        return name in self.commands
+
+    def __getitem__(self, name):
+        return self.commands[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        return self.commands.items()
+
+    # resolves a command name, alias or, with abbreviate set, unique
+    # abbreviation
+    def lookup(self, word, abbreviate=True):
+        if word in self.commands:
+            return word
+        if word in self.aliases:
+            return self.aliases[word]
+        if not abbreviate or not self.prefixlen \
+                or len(word) < self.prefixlen:
+            return None
+        i = bisect.bisect_left(self.names, word)
+        if i == len(self.names) or not self.names[i].startswith(word):
+            return None
+        if i+1 < len(self.names) and self.names[i+1].startswith(word):
+            # ambiguous
+            return None
+        return self.names[i]
@@ -0,0 +1,231 @@
+import argparse
+import http.client
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from .partial import PartialFile
+
+# bytes read per call
+CHUNKSIZE = 1 << 20
+# ranges smaller than this are not worth an extra connection
+MINSEGMENT = 1 << 20
+
+class DownloadError(Exception):
+    pass
+
+class DownloadCancelled(DownloadError):
+    pass
+
+# the server answered a range request with the whole file
+class _NoRanges(Exception):
+    pass
+
+# fetches a URL into a partial file; if the server accepts byte ranges,
+# the file is preallocated and split into segments that are fetched
+# concurrently and written at their offsets, and ranges kept from an
+# earlier attempt are not fetched again; otherwise it is streamed over a
+# single connection
+class HttpDownloader(object):
+    def __init__(self, url, partial, segments=4, timeout=30,
+                 logger=logging.getLogger(), progress=None, cancelled=None):
+        super(HttpDownloader,self).__init__()
+        self.url      = url
+        self.partial  = partial
+        self.segments = segments
+        self.timeout  = timeout
+        self.logger   = logger
+        # progress(nbytes) is called with the number of new bytes, one call
+        # at a time; cancelled() is polled between reads
+        self.progress  = progress
+        self.cancelled = cancelled or (lambda: False)
+
+        self.lock     = threading.Lock()
+        self.total    = None
+        # bytes reported to progress
+        self.received = 0
+
+    # public interface
+    # fills the partial file, which is left open; returns the number of
+    # bytes of the file, raises DownloadError or OSError
+    def run(self):
+        try:
+            return self._run()
+        except http.client.HTTPException as e:
+            raise DownloadError(f'{self.url}: {e!r}') from e
+
+    # internal functions
+    def _run(self):
+        size, ranges = self._probe()
+        self.total = size
+        self.partial.size = size
+        # without ranges, data of an earlier attempt can't be used
+        self.partial.open(restart=not ranges)
+        done = self.partial.done
+        if done:
+            self.logger.info(f'Resuming {self.url} at {done}/{size} bytes')
+            self._report(done)
+        if ranges and size:
+            segments = self._plan(self.partial.missing())
+            if len(segments) > 1 or done:
+                try:
+                    return self._fetch_segments(segments)
+                except _NoRanges:
+                    self.logger.debug('Range request ignored, streaming')
+                    self.partial.open(restart=True)
+                    self._report(-self.received)
+        return self._fetch_stream()
+
+    # returns (size or None, whether byte ranges are accepted)
+    def _probe(self):
+        request = urllib.request.Request(self.url, method='HEAD')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as r:
+                length = r.headers.get('Content-Length', None)
+                ranges = r.headers.get('Accept-Ranges', '') == 'bytes'
+        except urllib.error.HTTPError as e:
+            # HEAD not supported, find out while streaming
+            self.logger.debug(f'HEAD {self.url} failed: {e}')
+            return None, False
+        size = int(length) if length and length.isdigit() else None
+        return size, ranges
+
+    # splits the missing ranges into about as many segments as allowed,
+    # none smaller than MINSEGMENT unless the range is
+    def _plan(self, gaps):
+        missing  = sum(end - start for start, end in gaps)
+        segments = []
+        for start, end in gaps:
+            n = min(self.segments * (end - start) // missing,
+                    (end - start) // MINSEGMENT)
+            step = -(-(end - start) // max(n, 1))
+            segments += [
+                (s, min(s + step, end)) for s in range(start, end, step)
+            ]
+        return segments
+
+    def _fetch_stream(self):
+        request = urllib.request.Request(self.url)
+        with urllib.request.urlopen(request, timeout=self.timeout) as r:
+            length = r.headers.get('Content-Length', None)
+            if length and length.isdigit():
+                self.total = int(length)
+                self.partial.size = self.total
+            written = self._copy(r, 0, self.total)
+        if self.total is not None and written != self.total:
+            raise DownloadError(
+                f'Incomplete download, {written}/{self.total} bytes'
+            )
+        return written
+
+    def _fetch_segments(self, segments):
+        missing = sum(end - start for start, end in segments)
+        self.logger.debug(
+            f'Fetching {missing}/{self.total} bytes in {len(segments)}'
+            ' segments'
+        )
+        self.partial.allocate()
+        errors  = []
+        threads = []
+        for start, end in segments:
+            t = threading.Thread(
+                target=self._run_segment, args=(start, end, errors),
+                name=f'segment-{start}', daemon=True
+            )
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        for e in errors:
+            if isinstance(e, _NoRanges):
+                raise e
+        if len(errors):
+            raise errors[0]
+        return self.total
+
+    def _run_segment(self, start, end, errors):
+        try:
+            self._fetch_range(start, end, errors)
+        except Exception as e:
+            with self.lock:
+                errors.append(e)
+
+    def _fetch_range(self, start, end, errors):
+        request = urllib.request.Request(
+            self.url, headers={'Range': f'bytes={start}-{end-1}'}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as r:
+            if r.status != 206:
+                raise _NoRanges()
+            written = self._copy(r, start, end - start, errors)
+        if written != end - start:
+            raise DownloadError(
+                f'Incomplete range {start}-{end-1}, {written} bytes'
+            )
+
+    # copies the response to the partial file at offset, stops early once
+    # another segment failed
+    def _copy(self, response, offset, length, errors=()):
+        buffer = bytearray(CHUNKSIZE)
+        view   = memoryview(buffer)
+        written = 0
+        while length is None or written < length:
+            if self.cancelled():
+                raise DownloadCancelled('Download cancelled')
+            if len(errors):
+                break
+            want = CHUNKSIZE
+            if length is not None:
+                want = min(want, length - written)
+            nbytes = response.readinto(view[:want])
+            if not nbytes:
+                break
+            self.partial.write(offset + written, view[:nbytes])
+            written += nbytes
+            self._report(nbytes)
+        return written
+
+    def _report(self, nbytes):
+        with self.lock:
+            self.received += nbytes
+            if self.progress:
+                self.progress(nbytes)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m presence.download',
+        description='fetch a URL like an OOB file transfer'
+    )
+    parser.add_argument('url')
+    parser.add_argument('path')
+    parser.add_argument('-s', '--segments', type=int, default=4,
+                        help='maximum number of concurrent ranges'
+                        ' (default: 4)')
+    parser.add_argument('-t', '--timeout', type=float, default=30,
+                        help='timeout in seconds (default: 30)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='[%(threadName)s] %(message)s')
+    logger = logging.getLogger('presence.download')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    # an interrupted download is resumed by running the same command again
+    partial = PartialFile(args.path, args.url, logger=logger)
+    start = time.perf_counter()
+    try:
+        nbytes = HttpDownloader(
+            args.url, partial, segments=args.segments,
+            timeout=args.timeout, logger=logger
+        ).run()
+    except BaseException:
+        partial.close()
+        raise
+    checksum = partial.finish()
+    elapsed = time.perf_counter() - start
+    print(f'{nbytes} bytes in {elapsed:.2f}s,'
+          f' {nbytes / elapsed / (1 << 20):.1f} MiB/s, sha256 {checksum}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import collections
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+Entry = collections.namedtuple('Entry', ['name', 'is_dir', 'size', 'mtime'])
+
+# sort keys, largest and newest first like ls -S and ls -t
+SortKey = {
+    'name': (lambda e: e.name, False),
+    'size': (lambda e: (e.size, e.name), True),
+    'date': (lambda e: (e.mtime, e.name), True),
+}
+
+# cached directory contents, rescanned when the directory's mtime changes
+class DirectoryIndex(object):
+    def __init__(self, logger=logging.getLogger()):
+        super(DirectoryIndex,self).__init__()
+        self.logger = logger
+        self.lock   = threading.Lock()
+        # path -> (directory mtime, scan time, {sort key: entries})
+        self.indexes = {}
+
+    # entries of a directory, sorted and filtered by a glob pattern;
+    # raises OSError if the directory cannot be read
+    def entries(self, path, sort='name', reverse=False, pattern=None):
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            index = self.indexes.get(path, None)
+        # entries changed within the same second as the last scan may have
+        # been missed, rescan until the mtime is older than the scan
+        if not index or index[0] != mtime or index[1] - mtime < 1e9:
+            index = (mtime, time.time_ns(), {'name': self._scan(path)})
+            with self.lock:
+                self.indexes[path] = index
+        entries = index[2].get(sort, None)
+        if entries is None:
+            key, descending = SortKey[sort]
+            entries = sorted(index[2]['name'], key=key, reverse=descending)
+            index[2][sort] = entries
+        if pattern:
+            entries = [e for e in entries if fnmatch.fnmatch(e.name, pattern)]
+        if reverse:
+            entries = entries[::-1]
+        return entries
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+
+    # internal functions
+    def _scan(self, path):
+        self.logger.debug(f'Scanning {path}')
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                # hidden files, including the .part files of downloads
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                    stat = entry.stat()
+                except OSError:
+                    # removed while scanning
+                    continue
+                entries.append(Entry(
+                    entry.name, is_dir, 0 if is_dir else stat.st_size,
+                    stat.st_mtime
+                ))
+        entries.sort(key=SortKey['name'][0])
+        return entries
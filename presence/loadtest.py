@@ -0,0 +1,243 @@
+import argparse
+import asyncio
+import collections
+import logging
+import random
+import socket
+import time
+import xml.parsers.expat
+
+import psutil
+
+from .parser import Parser
+from .types  import *
+
+def percentile(values, p):
+    if not len(values):
+        return float('nan')
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+# message/command mix, e.g. "echo=5,help=1,users=1,broadcast=3"
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        mix[name.strip()] = float(weight) if len(weight) else 1.0
+    return mix
+
+# latency samples of one step
+class Stats(object):
+    def __init__(self):
+        super(Stats,self).__init__()
+        self.connect   = []
+        self.command   = []
+        self.broadcast = []
+        self.sent      = 0
+        self.received  = 0
+        self.errors    = 0
+
+# one simulated link-local peer
+class Peer(object):
+    def __init__(self, n, args, stats, logger):
+        super(Peer,self).__init__()
+        self.jid    = f'{args.prefix}{n}@loadtest'
+        self.args   = args
+        self.stats  = stats
+        self.logger = logger
+        self.rng    = random.Random(args.seed + n)
+        self.parser = Parser(logger=logger, maxsize=0)
+        self.parser.register(ResultType.MESSAGE, self._message)
+        self.parser.register(ResultType.STREAM_OPEN, self._stream_open)
+        self.opened  = asyncio.Event()
+        self.pending = collections.deque()
+        self.reader  = None
+        self.writer  = None
+        self.seq     = 0
+
+    async def connect(self):
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(
+            self.args.host, self.args.port
+        )
+        self.writer.write(
+            f"<stream:stream xmlns='jabber:client'"
+            f" xmlns:stream='http://etherx.jabber.org/streams'"
+            f" from='{self.jid}' to='{self.args.to}' version='1.0'>".encode()
+        )
+        asyncio.get_running_loop().create_task(self._read_loop())
+        await self.opened.wait()
+        self.stats.connect.append(time.perf_counter() - start)
+
+    async def send(self, kind):
+        if kind == 'broadcast':
+            text = f'lt {self.seq} {time.perf_counter_ns()}'
+        elif kind == 'echo':
+            text = f'echo lt-echo {self.seq}'
+            self.pending.append(time.perf_counter())
+        else:
+            text = kind
+            self.pending.append(time.perf_counter())
+        self.seq += 1
+        self.writer.write(
+            f"<message from='{self.jid}' to='{self.args.to}' type='chat'>"
+            f"<body>{text}</body></message>".encode()
+        )
+        self.stats.sent += 1
+        await self.writer.drain()
+
+    async def run(self, duration, mix):
+        kinds   = list(mix.keys())
+        weights = list(mix.values())
+        end = time.perf_counter() + duration
+        interval = 1 / self.args.rate
+        # spread the peers' sends over the interval
+        await asyncio.sleep(self.rng.random() * interval)
+        while time.perf_counter() < end:
+            await self.send(self.rng.choices(kinds, weights)[0])
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self.writer:
+            self.writer.write(b'</stream:stream>')
+            self.writer.close()
+
+    # internal functions
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not len(data):
+                    break
+                self.parser.process(data)
+        except (ConnectionError, xml.parsers.expat.ExpatError) as e:
+            self.logger.debug(f'{self.jid}: {e}')
+            self.stats.errors += 1
+
+    def _stream_open(self, result):
+        self.opened.set()
+
+    def _message(self, result):
+        now = time.perf_counter()
+        self.stats.received += 1
+        words = result.data.ascii.split()
+        if len(words) == 4 and words[1] == 'lt':
+            # "<sender>: lt <seq> <send time>"
+            sent = int(words[3]) / 1e9
+            self.stats.broadcast.append(now - sent)
+        elif len(self.pending):
+            self.stats.command.append(now - self.pending.popleft())
+
+def server_usage(pid):
+    if not pid:
+        return None
+    try:
+        p = psutil.Process(pid)
+        return p.memory_info().rss, p.num_threads()
+    except psutil.Error:
+        return None
+
+def _ms(value):
+    return f'{1000 * value:8.2f}'
+
+async def run(args, logger):
+    mix   = parse_mix(args.mix)
+    peers = []
+    steps = list(range(args.step, args.clients + 1, args.step))
+    if not len(steps) or steps[-1] != args.clients:
+        steps.append(args.clients)
+
+    print(f'{"clients":>7} {"conn/s":>8}'
+          f' {"cmd p50":>8} {"cmd p99":>8} {"bc p50":>8} {"bc p99":>8}'
+          f' {"sent":>7} {"recv":>8} {"err":>4} {"rss MiB":>8} {"threads":>7}')
+    for nclients in steps:
+        stats = Stats()
+        start = time.perf_counter()
+        new = [
+            Peer(n, args, stats, logger) for n in range(len(peers), nclients)
+        ]
+        results = await asyncio.gather(
+            *(asyncio.wait_for(p.connect(), args.timeout) for p in new),
+            return_exceptions=True
+        )
+        elapsed = time.perf_counter() - start
+        for p, r in zip(new, results):
+            if isinstance(r, Exception):
+                logger.debug(f'{p.jid}: connect failed: {r!r}')
+                stats.errors += 1
+            else:
+                peers.append(p)
+        for p in peers:
+            p.stats = stats
+        connrate = len(stats.connect) / elapsed if elapsed else float('inf')
+
+        await asyncio.gather(*(p.run(args.duration, mix) for p in peers))
+        # let outstanding replies arrive
+        await asyncio.sleep(args.settle)
+
+        usage = server_usage(args.pid)
+        rss, threads = ('-', '-')
+        if usage:
+            rss, threads = f'{usage[0] / (1 << 20):.1f}', str(usage[1])
+        print(f'{len(peers):>7} {connrate:>8.1f}'
+              f' {_ms(percentile(stats.command, 50))}'
+              f' {_ms(percentile(stats.command, 99))}'
+              f' {_ms(percentile(stats.broadcast, 50))}'
+              f' {_ms(percentile(stats.broadcast, 99))}'
+              f' {stats.sent:>7} {stats.received:>8} {stats.errors:>4}'
+              f' {rss:>8} {threads:>7}', flush=True)
+        if len(peers) < nclients:
+            break
+
+    for p in peers:
+        p.close()
+    await asyncio.sleep(0.1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m presence.loadtest',
+        description='simulate many link-local XMPP peers against a server'
+    )
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='server address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=5298,
+                        help='server port (default: 5298)')
+    parser.add_argument('--to', default=socket.gethostname() + '.local',
+                        help='server identity (default: <hostname>.local)')
+    parser.add_argument('-n', '--clients', type=int, default=100,
+                        help='number of peers at the last step (default: 100)')
+    parser.add_argument('-s', '--step', type=int, default=25,
+                        help='peers added per step (default: 25)')
+    parser.add_argument('-d', '--duration', type=float, default=5,
+                        help='seconds of traffic per step (default: 5)')
+    parser.add_argument('-r', '--rate', type=float, default=1,
+                        help='messages per second per peer (default: 1)')
+    parser.add_argument('-m', '--mix',
+                        default='echo=5,help=1,users=1,broadcast=3',
+                        help='weighted message mix'
+                        ' (default: echo=5,help=1,users=1,broadcast=3)')
+    parser.add_argument('-p', '--pid', type=int, default=None,
+                        help='server pid for RSS and thread count')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='connect timeout in seconds (default: 10)')
+    parser.add_argument('--settle', type=float, default=1,
+                        help='seconds to wait for replies after each step'
+                        ' (default: 1)')
+    parser.add_argument('--prefix', default='lt',
+                        help='local part prefix of peer JIDs (default: lt)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(message)s')
+    logger = logging.getLogger('presence.loadtest')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    try:
+        asyncio.run(run(args, logger))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -5,15 +5,156 @@ import os
 import signal
 import sys
 import psutil
+import threading
 import time
 
 from pidfile import PidFile
 
 from daemon import DaemonContext
 
-from .server import PresenceServer
+from .bus      import BusClient, MessageBus
+from .metrics  import Metrics
+from .profiler import SamplingProfiler
+from .server   import AsyncPresenceServer, PresenceServer
 
-def _main(name, daemon, loglevel, client_args):
+def _metrics(logger, client_args, bus=None):
+    path = client_args.get('metricsfile', None)
+    metrics = Metrics(
+        enabled=bool(client_args.get('metrics', False) or path), logger=logger
+    )
+    if path:
+        if bus:
+            # one file per worker process
+            root, ext = os.path.splitext(path)
+            path = f'{root}-{bus.worker}{ext}'
+        metrics.start(path, client_args.get('metricsinterval', 60))
+    return metrics
+
+# SIGUSR1 toggles the profiler, SIGUSR2 dumps all thread stacks and the
+# profile to <dumppath>.<pid>.profile
+def _install_profiler(logger, client_args, dumppath):
+    profiler = SamplingProfiler(
+        client_args.get('profileinterval', 0.01), logger=logger
+    )
+    def run(func, *args):
+        # keep the signal handler short, it interrupts the main thread
+        t = threading.Thread(target=func, args=args, daemon=True)
+        t.start()
+    def dump():
+        try:
+            profiler.dump(f'{dumppath}.{os.getpid()}.profile')
+        except OSError as e:
+            logger.error(f'Writing profile failed: {e}')
+    signal.signal(signal.SIGUSR1, lambda signum, frame: run(profiler.toggle))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: run(dump))
+    return profiler
+
+def _serve(logger, engine, client_args, reuseport=False, bus=None,
+           dumppath=None):
+    if dumppath:
+        _install_profiler(logger, client_args, dumppath)
+    metrics = _metrics(logger, client_args, bus)
+    try:
+        _run_server(logger, engine, client_args, reuseport, bus, metrics)
+    finally:
+        metrics.stop()
+
+def _run_server(logger, engine, client_args, reuseport, bus, metrics):
+    if engine == 'asyncio':
+        # all clients share one event loop, no thread per connection
+        p = AsyncPresenceServer(
+            logger=logger, reuseport=reuseport,
+            poolsize=client_args.get('commandpool', 4),
+            cachesize=client_args.get('commandcache', 128),
+            metrics=metrics,
+            transferpool=client_args.get('transferpool', 2),
+            transferqueue=client_args.get('transferqueue', 16)
+        )
+        if bus:
+            p.attach_bus(bus)
+        try:
+            p.serve_forever(client_args)
+        except KeyboardInterrupt:
+            logger.info("Interrupted by user")
+        return
+
+    # create server and listen on default socket 5298
+    p = PresenceServer(
+        logger=logger, reuseport=reuseport,
+        poolsize=client_args.get('commandpool', 4),
+        cachesize=client_args.get('commandcache', 128),
+        metrics=metrics,
+        transferpool=client_args.get('transferpool', 2),
+        transferqueue=client_args.get('transferqueue', 16)
+    )
+    if bus:
+        p.attach_bus(bus)
+    p.listen()
+    
+    # wait for client to connect
+    try:
+        while True:
+            p.wait_for_connect(client_args)
+    except KeyboardInterrupt:
+        logger.info("Interrupted by user")
+    
+    # close client connections and server socket
+    p.cleanup()
+
+def _run_workers(logger, workers, buspath, dumppath, engine, client_args):
+    # bind before forking so workers can connect right away
+    bus = MessageBus(buspath, logger=logger)
+    bus.listen()
+
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            bus.serversocket.close()
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            client = BusClient(buspath, worker, logger=logger)
+            try:
+                client.connect()
+                _serve(logger, engine, client_args, reuseport=True, bus=client,
+                       dumppath=dumppath)
+            finally:
+                client.close()
+                logging.shutdown()
+                os._exit(0)
+        logger.info(f'Started worker {worker}, pid {pid}')
+        pids.append(pid)
+
+    # profile signals sent to the parent apply to all workers
+    def forward(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+
+    bus.start()
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Stopping workers")
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    bus.cleanup()
+
+def _main(name, daemon, loglevel, engine, workers, buspath, dumppath,
+          client_args):
     logger = logging.getLogger(name)
     logger.setLevel(loglevel)
     
@@ -35,19 +176,10 @@ def _main(name, daemon, loglevel, client_args):
         handler.setFormatter(logFormatter)
         logger.addHandler(handler)
     
-    # create server and listen on default socket 5298
-    p = PresenceServer(logger=logger)
-    p.listen()
-    
-    # wait for client to connect
-    try:
-        while True:
-            p.wait_for_connect(client_args)
-    except KeyboardInterrupt:
-        logger.info("Interrupted by user")
-    
-    # close client connections and server socket
-    p.cleanup()
+    if workers > 1:
+        _run_workers(logger, workers, buspath, dumppath, engine, client_args)
+    else:
+        _serve(logger, engine, client_args, dumppath=dumppath)
 
 def main(name, client_args={}):
     parser = argparse.ArgumentParser(description=name)
@@ -59,6 +191,12 @@ def main(name, client_args={}):
                          help='force start on bogus lockfile')
     parser.add_argument('-v', '--verbose', action="store_true",
                          help='')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'],
+                         default='thread',
+                         help='client engine (default: thread)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                         help='number of worker processes sharing the port'
+                         ' (default: 1)')
     args = parser.parse_args()
     
     if args.verbose:
@@ -70,6 +208,8 @@ def main(name, client_args={}):
         lock = f'/var/run/{name}.lock'
     else:
         lock = os.path.join(os.environ['HOME'],f'.{name}.lock')
+    buspath  = os.path.splitext(lock)[0] + '.bus'
+    dumppath = os.path.splitext(lock)[0]
 
     pid = -1
     if os.path.exists(lock):
@@ -110,6 +250,8 @@ def main(name, client_args={}):
 
     if args.daemon:
         with DaemonContext(umask=0o002, pidfile=PidFile(lock)):
-            _main(name, args.daemon, loglevel, client_args)
+            _main(name, args.daemon, loglevel, args.engine, args.workers,
+                  buspath, dumppath, client_args)
     else:
-        _main(name, args.daemon, loglevel, client_args)
+        _main(name, args.daemon, loglevel, args.engine, args.workers,
+              buspath, dumppath, client_args)
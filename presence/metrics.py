@@ -0,0 +1,208 @@
+import bisect
+import json
+import logging
+import os
+import threading
+
+# default histogram buckets in seconds
+BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0
+)
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, helptext='', labels={}):
+        super(Counter,self).__init__()
+        self.name     = name
+        self.helptext = helptext
+        self.labels   = dict(labels)
+        self.lock     = threading.Lock()
+        self.value    = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def get(self):
+        return self.value
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    # with func set, the value is read from func() when exported
+    def __init__(self, name, helptext='', labels={}, func=None):
+        super(Gauge,self).__init__(name, helptext, labels)
+        self.func = func
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def get(self):
+        if self.func:
+            return self.func()
+        return self.value
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, helptext='', labels={}, buckets=BUCKETS):
+        super(Histogram,self).__init__()
+        self.name     = name
+        self.helptext = helptext
+        self.labels   = dict(labels)
+        self.lock     = threading.Lock()
+        self.buckets  = tuple(buckets)
+        # the last count is for values above the largest bucket
+        self.counts   = [0] * (len(self.buckets) + 1)
+        self.sum      = 0.0
+        self.count    = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum       += value
+            self.count     += 1
+
+    def get(self):
+        with self.lock:
+            return self.count, self.sum, list(self.counts)
+
+# stands in for all metrics when collection is disabled
+class _NullMetric(object):
+    def inc(self, n=1):
+        pass
+
+    def dec(self, n=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+_null = _NullMetric()
+
+# registry of all metrics of a server, shared by its clients
+class Metrics(object):
+    def __init__(self, enabled=True, logger=logging.getLogger()):
+        super(Metrics,self).__init__()
+        self.enabled = enabled
+        self.logger  = logger
+        self.lock    = threading.Lock()
+        # (name, labels) -> metric, in order of registration
+        self.metrics = {}
+
+        self.writer  = None
+        self.stopped = threading.Event()
+
+    # metrics with the same name and labels are shared; with collection
+    # disabled, a no-op stand-in is returned
+    def counter(self, name, helptext='', **labels):
+        return self._get(Counter, name, helptext, labels)
+
+    def gauge(self, name, helptext='', func=None, **labels):
+        return self._get(Gauge, name, helptext, labels, func=func)
+
+    def histogram(self, name, helptext='', buckets=BUCKETS, **labels):
+        return self._get(Histogram, name, helptext, labels, buckets=buckets)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.metrics.values()))
+
+    # export formats
+    def to_json(self):
+        out = {}
+        for m in self:
+            entry = {'labels': m.labels}
+            if m.kind == 'histogram':
+                count, total, counts = m.get()
+                entry.update(count=count, sum=total, buckets={
+                    str(le): n for le, n in zip(m.buckets + ('+Inf',), counts)
+                })
+            else:
+                entry['value'] = m.get()
+            out.setdefault(m.name, []).append(entry)
+        return json.dumps(out, indent=1)
+
+    def to_prometheus(self):
+        lines = []
+        seen  = set()
+        # samples of one metric have to be grouped
+        for m in sorted(self, key=lambda m: m.name):
+            if m.name not in seen:
+                seen.add(m.name)
+                lines.append(f'# HELP {m.name} {m.helptext}')
+                lines.append(f'# TYPE {m.name} {m.kind}')
+            if m.kind != 'histogram':
+                lines.append(f'{m.name}{_labels(m.labels)} {m.get()}')
+                continue
+            count, total, counts = m.get()
+            cumulative = 0
+            for le, n in zip(m.buckets + ('+Inf',), counts):
+                cumulative += n
+                labels = _labels(dict(m.labels, le=str(le)))
+                lines.append(f'{m.name}_bucket{labels} {cumulative}')
+            lines.append(f'{m.name}_sum{_labels(m.labels)} {total}')
+            lines.append(f'{m.name}_count{_labels(m.labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    # files ending in .json are written as JSON, others in the Prometheus
+    # text format
+    def write(self, path):
+        if path.endswith('.json'):
+            data = self.to_json()
+        else:
+            data = self.to_prometheus()
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def start(self, path, interval=60):
+        if not self.enabled or self.writer:
+            return
+        self.logger.info(f'Writing metrics to {path} every {interval}s')
+        self.writer = threading.Thread(
+            target=self._write_loop, args=(path, interval),
+            name='metrics', daemon=True
+        )
+        self.writer.start()
+
+    def stop(self):
+        if not self.writer:
+            return
+        self.stopped.set()
+        self.writer.join(5)
+        self.writer = None
+
+    # internal functions
+    def _get(self, cls, name, helptext, labels, **kwargs):
+        if not self.enabled:
+            return _null
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key, None)
+            if metric is None:
+                metric = cls(name, helptext, labels, **kwargs)
+                self.metrics[key] = metric
+        return metric
+
+    def _write_loop(self, path, interval):
+        while True:
+            stopped = self.stopped.wait(interval)
+            try:
+                self.write(path)
+            except OSError as e:
+                self.logger.error(f'Writing metrics failed: {e}')
+            if stopped:
+                return
+
+def _labels(labels):
+    if not len(labels):
+        return ''
+    items = []
+    for k, v in labels.items():
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"')
+        items.append(f'{k}="{v}"'.replace('\n', '\\n'))
+    return '{' + ','.join(items) + '}'
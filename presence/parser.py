@@ -1,15 +1,33 @@
+import collections
 import html
 import logging
+import time
 
 import xml.parsers.expat
 
-from .types import *
+from .metrics import Metrics
+from .types   import *
 
 # xml parser
 class Parser(object):
-    def __init__(self,logger=logging.getLogger()):
+    def __init__(self,logger=logging.getLogger(),maxsize=1<<20,metrics=None):
         super(Parser,self).__init__()
         self.logger = logger
+        # maximum size of a single stanza in bytes, 0 for no limit
+        self.maxsize = maxsize
+
+        self.metrics = metrics or Metrics(enabled=False)
+        self.parse_time = self.metrics.histogram(
+            'presence_parse_seconds',
+            'time to parse a received chunk, including result handlers'
+        )
+        self.result_counts = [
+            self.metrics.counter(
+                'presence_results_total', 'parser results by type', type=t
+            ) for t in ResultTypeStr
+        ]
+        # results of this connection alone, shown per user by stats
+        self.counts = [0] * len(ResultTypeStr)
         
         # create parser and set handlers
         self.parser = xml.parsers.expat.ParserCreate()
@@ -31,24 +49,144 @@ class Parser(object):
         self.mode  = self.IDLE
         
         # xml start and end elements to ignore
-        self.ignore = ['font', 'composing', 'id', 'si', 'field']
+        self.ignore = frozenset(['font', 'composing', 'id', 'si', 'field'])
+
+        # element handlers, keyed by (name, xmlns) or by name only
+        self.start_handlers = {}
+        self.end_handlers   = {}
+        self.register_element(
+            'stream:stream', start=self._start_stream, end=self._end_stream)
+        self.register_element(
+            'message', start=self._start_message, end=self._end_message)
+        self.register_element(
+            'iq', start=self._start_iq, end=self._end_iq)
+        self.register_element(
+            'x', start=self._start_x_oob, end=self._end_x_oob,
+            xmlns='jabber:x:oob')
+        self.register_element('url', start=self._start_url)
+        self.register_element(
+            'html', start=self._start_html, end=self._end_html)
+        self.register_element(
+            'body', start=self._start_body, end=self._end_body)
+        self.register_element(
+            'file', start=self._start_si_file, xmlns=Protocol.SI_TRANSFER)
+        self.register_element('range', start=self._start_si_range)
+        self.register_element(
+            'feature', start=self._start_feature_neg,
+            end=self._end_feature_neg, xmlns=Protocol.FEATURE_NEG)
+        self.register_element(
+            'option', start=self._start_option, end=self._end_option)
+        self.register_element(
+            'value', start=self._start_value, end=self._end_value)
+        self.register_element(
+            'query', start=self._start_bytestreams, end=self._end_bytestreams,
+            xmlns=Protocol.BYTESTREAMS)
+        self.register_element('streamhost', start=self._start_streamhost)
+        # handler keys of the currently open elements
+        self.elements = []
         
-        self.results = []
-        self.current = None
+        self.results   = collections.deque()
+        self.callbacks = {}
+        self.current   = None
+        self.iq        = None
+        self.filename  = None
+        self.filesize  = None
+        # the sender of the SI file offer accepts ranged transfers
+        self.fileranges = False
+
+        # text fragments of the current message, joined at </message>
+        self.html_parts  = []
+        self.ascii_parts = []
+        self.text_parts  = []
+
+        # html elements without content, written as <name/>
+        self.void = frozenset(['br', 'hr', 'img'])
+
+        # stream offset where the current stanza started
+        self.stanza_start = None
+        # stream offset where the parser was last between stanzas, and
+        # bytes fed so far
+        self.boundary     = 0
+        self.fed          = 0
+        self.aborted      = False
         
     # public interface
     def process(self,text):
         if len(text) == 0:
             return True
-        self.parser.Parse(text,False)
+        if not self.aborted:
+            self._parse(text)
         return False
     
     def next(self):
         if not len(self.results):
             return None
-        return self.results.pop(0)
+        return self.results.popleft()
+
+    # results of this type are passed to func(result) as soon as they are
+    # complete instead of being queued
+    def register(self, resulttype, func):
+        self.callbacks[resulttype] = func
+
+    def unregister(self, resulttype):
+        self.callbacks.pop(resulttype, None)
+
+    # start(attrs) and end() are called for matching elements outside of
+    # HTML bodies; with xmlns set, only elements in that namespace match
+    def register_element(self, name, start=None, end=None, xmlns=None):
+        key = (name, xmlns) if xmlns else name
+        self.start_handlers[key] = start
+        self.end_handlers[key]   = end
+
+    def unregister_element(self, name, xmlns=None):
+        key = (name, xmlns) if xmlns else name
+        self.start_handlers.pop(key, None)
+        self.end_handlers.pop(key, None)
+
+    def ignore_element(self, name):
+        self.ignore = self.ignore | {name}
+
+    # parses text right away, returns an iterator over the queued results
+    def feed(self, text):
+        if len(text) and not self.aborted:
+            self._parse(text)
+        return self._drain()
 
     # internal helper functions
+    # expat buffers an unterminated tag without calling back, so data is
+    # fed only up to maxsize bytes past the start of the current stanza;
+    # callbacks move that point as stanzas complete
+    def _parse(self, text):
+        while len(text) and not self.aborted:
+            piece = text
+            if self.maxsize:
+                start = self.stanza_start
+                if start is None:
+                    start = self.boundary
+                room = start + self.maxsize - self.fed
+                if room <= 0:
+                    self._abort()
+                    return
+                piece, text = text[:room], text[room:]
+            else:
+                text = text[:0]
+            self._parse_piece(piece)
+            self.fed += len(piece)
+
+    def _parse_piece(self, text):
+        if not self.metrics.enabled:
+            self.parser.Parse(text,False)
+            return
+        start = time.perf_counter()
+        try:
+            self.parser.Parse(text,False)
+        finally:
+            self.parse_time.observe(time.perf_counter() - start)
+
+    def _drain(self):
+        while len(self.results):
+            yield self.results.popleft()
+
     def _set_mode(self,mode):
         self.logger.debug(f'Setting mode to "{self.modestr[mode]}"')
         self.mode = mode
@@ -58,156 +196,251 @@ class Parser(object):
             self.logger.error("Wrong mode")
         
     def _add_html_start_element(self, name, attrs):
-        self.current.html += f'<{name}'
+        self.html_parts.append(f'<{name}')
         for k,v in attrs.items():
-            self.current.html += f' {k}="{v}"'
-        self.current.html += '>'
+            self.html_parts.append(f' {k}="{html.escape(v)}"')
+        if name in self.void:
+            self.html_parts.append('/>')
+            if name == 'br':
+                self.text_parts.append('\n')
+        else:
+            self.html_parts.append('>')
+
+    def _check_size(self, extra=0):
+        if not self.maxsize or self.stanza_start is None:
+            return True
+        size = self.parser.CurrentByteIndex - self.stanza_start + extra
+        if size <= self.maxsize:
+            return True
+        self._abort()
+        return False
+
+    def _abort(self):
+        self.logger.error(
+            f'Stanza exceeds maximum size of {self.maxsize} bytes, aborting'
+        )
+        # drop everything buffered so far and ignore the rest of the stream
+        self.aborted = True
+        self.current = None
+        self.html_parts  = []
+        self.ascii_parts = []
+        self._set_mode(self.IDLE)
+        result = Result(type=ResultType.STREAM_ERROR,data='policy-violation')
+        self._add_result(result)
     
     def _add_result(self,result):
         self.logger.debug(f"Adding parser result {ResultTypeStr[result.type]}")
-        self.results.append(result)
+        self.result_counts[result.type].inc()
+        self.counts[result.type] += 1
+        callback = self.callbacks.get(result.type, None)
+        if callback:
+            callback(result)
+        else:
+            self.results.append(result)
         
     # expat parser callback functions
     def _start_element(self, name, attrs):
-        ignore = []
+        if self.aborted:
+            return
+        if len(self.elements) == 1:
+            # top-level stanza inside the stream
+            self.stanza_start = self.parser.CurrentByteIndex
+        elif not self._check_size():
+            return
         # check first if we are inside a HTML body tag
         if self.flags & self.HTMLBODY:
             self._check_mode(self.MESSAGE)
             self._add_html_start_element(name,attrs)
-        elif name in (ignore + self.ignore):
+            self.elements.append(None)
             return
-        elif name == 'stream:stream':
-            stream = Stream(identity=attrs['to'],other=attrs['from'])
-            result = Result(type=ResultType.STREAM_OPEN,data=stream)
-            self._add_result(result)
-        elif name == 'message':
-            self._check_mode(self.IDLE)
-            self._set_mode(self.MESSAGE)
-            self.current = Message(identity=attrs['to'],other=attrs['from'])
-        elif name == 'iq':
-            self.iq = IQ(identity=attrs['to'],other=attrs['from'],
-                         id=attrs['id'],type=attrs['type'])
-        elif name == 'x':
-            xmlns = attrs['xmlns']
-            if xmlns == 'jabber:x:oob':
-                self._check_mode(self.MESSAGE)
-                self._set_mode(self.FILE_OOB)
-                self.current = Transfer_OOB(
-                    self,
-                    identity=self.current.identity,
-                    other=self.current.identity
-                )
-        elif name == 'url':
-            if self.mode == self.FILE_OOB and attrs['type'] == 'file':
-                self.current.filename = ""
-                self.current.filesize = attrs['size']
-        elif name == 'html':
-            self.flags |= self.HTML
-        elif name == 'body':
-            if self.flags & self.HTML:
-                self.flags |= self.HTMLBODY
-            else:
-                self.flags |= self.BODY
-        elif name == 'file':
-            xmlns = attrs['xmlns']
-            if xmlns == Protocol.SI_TRANSFER:
-                self.filename = attrs['name']
-                self.filesize = attrs['size']
-        elif name == 'feature':
-            xmlns = attrs['xmlns']
-            if xmlns == Protocol.FEATURE_NEG:
-                self._set_mode(self.FEATURE_NEG)
-                self.current = FeatureNeg(iq_id=self.iq.id)
-        elif name == 'option':
-            self.flags |= self.OPTION
-        elif name == 'value':
-            self.flags |= self.VALUE
-        elif name == 'query':
-            xmlns = attrs['xmlns']
-            mode = attrs['mode']
-            if xmlns == Protocol.BYTESTREAMS:
-                self._check_mode(self.IDLE)
-                self._set_mode(self.FILE_SOCKS5)
-                self.current = Transfer_SOCKS5(
-                    self, identity=self.iq.identity, other=self.iq.other,
-                    sid=attrs['sid'], iq_id=self.iq.id, streamhosts=[])
-                if self.filename:
-                    self.current.filename = self.filename
-                    self.filename = None
-                if self.filesize:
-                    self.current.filesize = self.filesize
-                    self.filesize = None
-        elif name == 'streamhost':
-            jid = attrs['jid']
-            host = attrs['host']
-            port = attrs['port']
-            self.current.streamhosts.append((host, port, jid))
-        else:
+        if name in self.ignore:
+            self.elements.append(None)
+            return
+        key = (name, attrs.get('xmlns', None))
+        if key not in self.start_handlers:
+            key = name
+        self.elements.append(key)
+        handler = self.start_handlers.get(key, None)
+        if handler:
+            handler(attrs)
+        elif key not in self.end_handlers:
             self.logger.debug(f'Start element: {name} {str(attrs)}')
             
     def _end_element(self, name):
-        ignore = ['url', 'streamhost', 'file']
-        if name == 'html':
-            self.flags &= ~self.HTML
-        elif name == 'body':
-            if self.flags  &  self.HTML:
-                self.flags &= ~self.HTMLBODY
-            else:
-                self.flags &= ~self.BODY
-        elif self.flags & self.HTMLBODY:
+        if self.aborted:
+            return
+        key = self.elements.pop() if len(self.elements) else name
+        if len(self.elements) == 1:
+            self.stanza_start = None
+            self.boundary     = self.parser.CurrentByteIndex
+        if self.flags & self.HTMLBODY and name != 'body':
             self._check_mode(self.MESSAGE)
-            self.current.html += f'</{name}>'
-        elif name in (ignore + self.ignore):
-            pass
-        elif name == 'stream:stream':
-            result = Result(type=ResultType.STREAM_CLOSE,data=None)
+            if name not in self.void:
+                self.html_parts.append(f'</{name}>')
+            return
+        if key is None:
+            return
+        handler = self.end_handlers.get(key, None)
+        if handler:
+            handler()
+        elif key not in self.start_handlers:
+            self.logger.debug(f'End element: {name}')
+
+    # element handlers
+    def _start_stream(self, attrs):
+        stream = Stream(identity=attrs['to'],other=attrs['from'])
+        result = Result(type=ResultType.STREAM_OPEN,data=stream)
+        self._add_result(result)
+
+    def _end_stream(self):
+        result = Result(type=ResultType.STREAM_CLOSE,data=None)
+        self._add_result(result)
+
+    def _start_message(self, attrs):
+        self._check_mode(self.IDLE)
+        self._set_mode(self.MESSAGE)
+        self.current = Message(identity=attrs['to'],other=attrs['from'])
+        self.html_parts  = []
+        self.ascii_parts = []
+        self.text_parts  = []
+
+    def _end_message(self):
+        if self.mode == self.MESSAGE:
+            self.current.html  = ''.join(self.html_parts)
+            self.current.ascii = ''.join(self.ascii_parts)
+            self.current.text  = ''.join(self.text_parts).strip()
+            self.html_parts  = []
+            self.ascii_parts = []
+            self.text_parts  = []
+            result = Result(type=ResultType.MESSAGE,data=self.current)
             self._add_result(result)
-        elif name == 'message':
-            if self.mode == self.MESSAGE:
-                result = Result(type=ResultType.MESSAGE,data=self.current)
-                self._add_result(result)
-                self.current = None
-                self._set_mode(self.IDLE)
-        elif name == 'html':
-            self.flags &= ~self.HTML
-        elif name == 'body':
-            if self.flags & self.HTML:
-                self.flags &= ~self.HTMLBODY
-            else:
-                self.flags &= ~self.BODY
-        elif name == 'x':
-            if self.mode == self.FILE_OOB:
-                result = Result(type=ResultType.FILE_TRANSFER,data=self.current)
-                self._add_result(result)
-                self.current = None
-                self._set_mode(self.IDLE)
-        elif name == 'iq':
-            self.iq = None
-        elif name == 'feature':
-            self._check_mode(self.FEATURE_NEG)
-            result = Result(type=ResultType.FEATURE_NEG,data=self.current)
+            self.current = None
+            self._set_mode(self.IDLE)
+
+    def _start_iq(self, attrs):
+        self.iq = IQ(identity=attrs['to'],other=attrs['from'],
+                     id=attrs['id'],type=attrs['type'])
+
+    def _end_iq(self):
+        self.iq = None
+
+    def _start_x_oob(self, attrs):
+        self._check_mode(self.MESSAGE)
+        self._set_mode(self.FILE_OOB)
+        self.html_parts  = []
+        self.ascii_parts = []
+        self.text_parts  = []
+        self.current = Transfer_OOB(
+            self,
+            identity=self.current.identity,
+            other=self.current.identity
+        )
+
+    def _end_x_oob(self):
+        if self.mode == self.FILE_OOB:
+            result = Result(type=ResultType.FILE_TRANSFER,data=self.current)
             self._add_result(result)
             self.current = None
             self._set_mode(self.IDLE)
-        elif name == 'option':
-            self.flags &= ~self.OPTION
-        elif name == 'value':
-            self.flags &= ~self.VALUE
-        elif name == 'query':
-            if self.mode == self.FILE_SOCKS5:
-                result = Result(type=ResultType.FILE_TRANSFER,data=self.current)
-                self._add_result(result)
-                self.current = None
-                self._set_mode(self.IDLE)
+
+    def _start_url(self, attrs):
+        if self.mode == self.FILE_OOB and attrs.get('type', None) == 'file':
+            self.current.filename = ""
+            self.current.filesize = attrs['size']
+
+    def _start_html(self, attrs):
+        self.flags |= self.HTML
+
+    def _end_html(self):
+        self.flags &= ~self.HTML
+
+    def _start_body(self, attrs):
+        if self.flags & self.HTML:
+            self.flags |= self.HTMLBODY
         else:
-            self.logger.debug(f'End element: {name}')
-        
+            self.flags |= self.BODY
+
+    def _end_body(self):
+        if self.flags  &  self.HTML:
+            self.flags &= ~self.HTMLBODY
+        else:
+            self.flags &= ~self.BODY
+
+    def _start_si_file(self, attrs):
+        self.filename = attrs['name']
+        self.filesize = attrs['size']
+        self.fileranges = False
+
+    def _start_si_range(self, attrs):
+        if self.filename is not None:
+            self.fileranges = True
+
+    def _start_feature_neg(self, attrs):
+        self._set_mode(self.FEATURE_NEG)
+        self.current = FeatureNeg(
+            iq_id=self.iq.id, other=self.iq.other, filename=self.filename,
+            filesize=self.filesize, ranges=self.fileranges
+        )
+
+    def _end_feature_neg(self):
+        self._check_mode(self.FEATURE_NEG)
+        result = Result(type=ResultType.FEATURE_NEG,data=self.current)
+        self._add_result(result)
+        self.current = None
+        self._set_mode(self.IDLE)
+
+    def _start_option(self, attrs):
+        self.flags |= self.OPTION
+
+    def _end_option(self):
+        self.flags &= ~self.OPTION
+
+    def _start_value(self, attrs):
+        self.flags |= self.VALUE
+
+    def _end_value(self):
+        self.flags &= ~self.VALUE
+
+    def _start_bytestreams(self, attrs):
+        self._check_mode(self.IDLE)
+        self._set_mode(self.FILE_SOCKS5)
+        self.current = Transfer_SOCKS5(
+            self, identity=self.iq.identity, other=self.iq.other,
+            sid=attrs['sid'], iq_id=self.iq.id, streamhosts=[])
+        if self.filename:
+            self.current.filename = self.filename
+            self.filename = None
+        if self.filesize:
+            self.current.filesize = self.filesize
+            self.filesize = None
+        self.current.ranges = self.fileranges
+        self.fileranges = False
+
+    def _end_bytestreams(self):
+        if self.mode == self.FILE_SOCKS5:
+            result = Result(type=ResultType.FILE_TRANSFER,data=self.current)
+            self._add_result(result)
+            self.current = None
+            self._set_mode(self.IDLE)
+
+    def _start_streamhost(self, attrs):
+        jid = attrs['jid']
+        host = attrs['host']
+        port = attrs['port']
+        self.current.streamhosts.append((host, port, jid))
+
     def _char_data(self, data):
+        if self.aborted or not self._check_size(len(data)):
+            return
+        if len(self.elements) == 1:
+            # e.g. whitespace keepalives between stanzas
+            self.boundary = self.parser.CurrentByteIndex
         if self.mode == self.MESSAGE:
             if self.flags & (self.HTMLBODY):
-                self.current.html += html.escape(data, quote=False)
+                self.html_parts.append(html.escape(data, quote=False))
+                self.text_parts.append(data)
             else:
-                self.current.ascii += data
+                self.ascii_parts.append(data)
         elif self.mode == self.FEATURE_NEG:
             if self.flags & self.OPTION and self.flags & self.VALUE:
                 self.current.option_values.append(data)
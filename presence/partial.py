@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+# bytes read per call when hashing data already on disk
+CHUNKSIZE = 1 << 20
+# seconds between updates of the state file while downloading
+SAVEINTERVAL = 1.0
+
+# paths of the partial files open in this process
+_active      = set()
+_active_lock = threading.Lock()
+
+# a download kept across attempts: the data goes to a hidden .part file
+# next to its destination and a small JSON state file records the source,
+# the size and which byte ranges of the .part file are valid, so an
+# interrupted transfer continues where it stopped instead of starting
+# over; the SHA-256 of the file is computed while the data is written
+class PartialFile(object):
+    def __init__(self, destfile, source, size=None,
+                 logger=logging.getLogger()):
+        super(PartialFile,self).__init__()
+        self.destfile  = destfile
+        # identifies what is downloaded, e.g. the URL
+        self.source    = source
+        self.size      = size
+        self.logger    = logger
+        # the same name from different sources gets different files
+        directory, name = os.path.split(destfile)
+        tag = hashlib.sha256(source.encode()).hexdigest()[:8]
+        self.path      = os.path.join(directory, f'.{name}.{tag}.part')
+        self.statepath = f'{self.path}.state'
+
+        self.lock   = threading.Lock()
+        self.fd     = None
+        # sorted, disjoint [start, end) ranges of valid data
+        self.ranges = []
+        # data is hashed in file order, up to this offset
+        self.sha256 = hashlib.sha256()
+        self.hashed = 0
+        self.saved  = 0
+
+    # bytes at the start of the file kept from an earlier attempt, without
+    # opening it
+    def resumable(self):
+        ranges = self._load()
+        if len(ranges) and ranges[0][0] == 0:
+            return ranges[0][1]
+        return 0
+
+    # valid bytes at the start of the file
+    @property
+    def prefix(self):
+        with self.lock:
+            if len(self.ranges) and self.ranges[0][0] == 0:
+                return self.ranges[0][1]
+            return 0
+
+    @property
+    def done(self):
+        with self.lock:
+            return sum(end - start for start, end in self.ranges)
+
+    # byte ranges still to be fetched, the end of the last one is None
+    # if the size is unknown
+    def missing(self):
+        with self.lock:
+            gaps  = []
+            start = 0
+            for s, e in self.ranges:
+                if s > start:
+                    gaps.append((start, s))
+                start = e
+            if self.size is None or start < self.size:
+                gaps.append((start, self.size))
+            return gaps
+
+    # opens the .part file, keeping the data of an earlier attempt unless
+    # restart is set, and hashes the valid data at its start; raises
+    # FileExistsError while another transfer of the same source has it open
+    def open(self, restart=False):
+        if self.fd is not None:
+            os.close(self.fd)
+        else:
+            self._claim()
+        self.ranges = [] if restart else self._load()
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError:
+            self._release()
+            raise
+        if not len(self.ranges):
+            os.ftruncate(self.fd, 0)
+        self.sha256 = hashlib.sha256()
+        self.hashed = 0
+        if len(self.ranges) and self.ranges[0][0] == 0:
+            # the hash state of the earlier attempt is not kept, its data
+            # is read back once
+            self._catch_up(self.ranges[0][1])
+        self.saved = time.monotonic()
+        self._save()
+
+    # writes data at offset, may be called from several threads
+    def write(self, offset, data):
+        pos = 0
+        while pos < len(data):
+            pos += os.pwrite(self.fd, data[pos:], offset + pos)
+        end = offset + len(data)
+        with self.lock:
+            if offset == self.hashed:
+                self.sha256.update(data)
+                self.hashed = end
+            self._add(offset, end)
+            now = time.monotonic()
+            if now - self.saved >= SAVEINTERVAL:
+                self.saved = now
+                self._save()
+
+    # reserves the space of the whole file, writes then land at their
+    # offsets
+    def allocate(self):
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.fd, 0, self.size)
+        else:
+            os.ftruncate(self.fd, self.size)
+
+    # keeps the data for the next attempt
+    def close(self):
+        if self.fd is None:
+            return
+        self._close()
+        with self.lock:
+            self._save()
+
+    # moves the complete file to its destination, returns its SHA-256
+    def finish(self):
+        with self.lock:
+            end = self.size
+            if end is None:
+                end = self.ranges[-1][1] if len(self.ranges) else 0
+            self._catch_up(end)
+            checksum = self.sha256.hexdigest()
+        self._close()
+        os.replace(self.path, self.destfile)
+        self._remove(self.statepath)
+        return checksum
+
+    def discard(self):
+        if self.fd is None:
+            return
+        self._close()
+        self._remove(self.path)
+        self._remove(self.statepath)
+
+    # internal functions
+    def _claim(self):
+        with _active_lock:
+            if self.path in _active:
+                raise FileExistsError(
+                    f'{self.path} is in use by another transfer'
+                )
+            _active.add(self.path)
+
+    def _release(self):
+        with _active_lock:
+            _active.discard(self.path)
+
+    def _close(self):
+        os.close(self.fd)
+        self.fd = None
+        self._release()
+
+    def _add(self, start, end):
+        ranges = []
+        for s, e in self.ranges:
+            if e < start or s > end:
+                ranges.append([s, e])
+            else:
+                start, end = min(s, start), max(e, end)
+        ranges.append([start, end])
+        self.ranges = sorted(ranges)
+
+    # hashes data on disk from the hash offset up to end
+    def _catch_up(self, end):
+        while self.hashed < end:
+            data = os.pread(
+                self.fd, min(CHUNKSIZE, end - self.hashed), self.hashed
+            )
+            if not len(data):
+                raise OSError(f'{self.path} is shorter than expected')
+            self.sha256.update(data)
+            self.hashed += len(data)
+
+    # valid ranges recorded for the same source and size, if the .part
+    # file still has them
+    def _load(self):
+        try:
+            with open(self.statepath) as f:
+                state = json.load(f)
+            length = os.path.getsize(self.path)
+        except (OSError, ValueError):
+            return []
+        if state.get('source') != self.source or self.size is None \
+                or state.get('size') != self.size:
+            self.logger.debug(f'Ignoring stale partial file {self.path}')
+            return []
+        ranges = [
+            [s, e] for s, e in state.get('ranges', [])
+            if 0 <= s < e <= min(length, self.size)
+        ]
+        return sorted(ranges)
+
+    def _save(self):
+        state = {
+            'source': self.source, 'size': self.size, 'ranges': self.ranges
+        }
+        tmp = f'{self.statepath}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self.statepath)
+        except OSError as e:
+            self.logger.warning(f'Saving {self.statepath} failed: {e}')
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
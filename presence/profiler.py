@@ -0,0 +1,135 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+# samples the stacks of all threads of the process; unlike cProfile,
+# which only sees the thread it was enabled in, this covers every client
+# thread without their cooperation
+class SamplingProfiler(object):
+    def __init__(self, interval=0.01, logger=logging.getLogger()):
+        super(SamplingProfiler,self).__init__()
+        self.interval = interval
+        self.logger   = logger
+        self.lock     = threading.Lock()
+        self.thread   = None
+        self.stopped  = threading.Event()
+        self._reset()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    # public interface
+    def start(self):
+        if self.thread:
+            return
+        with self.lock:
+            self._reset()
+            self.started = time.monotonic()
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._sample_loop, name='profiler', daemon=True
+        )
+        self.thread.start()
+        self.logger.info(f'Profiling every {1000 * self.interval:.0f} ms')
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.elapsed = time.monotonic() - self.started
+        self.logger.info(
+            f'Profiling stopped after {self.samples} samples'
+        )
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    # hot functions of the current or last session
+    def report(self, top=40):
+        with self.lock:
+            samples = self.samples
+            elapsed = self.elapsed
+            if self.running:
+                elapsed = time.monotonic() - self.started
+            own     = self.own.most_common(top)
+            total   = dict(self.total)
+            threads = self.threads.most_common()
+        if not samples:
+            return 'No profile samples\n'
+        lines = [
+            f'{samples} samples in {elapsed:.1f}s,'
+            f' every {1000 * self.interval:.0f} ms (wall clock, threads'
+            f' blocked in I/O are included)',
+            '',
+            'samples per thread:',
+        ]
+        for name, n in threads:
+            lines.append(f'  {n:>8}  {name}')
+        # percentages of all sampled stacks
+        stacks = sum(n for _, n in threads)
+        lines += ['', f'{"own %":>8} {"total %":>8}  function']
+        for code, n in own:
+            lines.append(
+                f'{100 * n / stacks:>8.1f} {100 * total[code] / stacks:>8.1f}'
+                f'  {_function(code)}'
+            )
+        return '\n'.join(lines) + '\n'
+
+    # writes the stacks of all threads and the profile report
+    def dump(self, path):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        lines = [f'{time.strftime("%Y-%m-%d %H:%M:%S")} pid {os.getpid()}\n']
+        for tid, frame in sys._current_frames().items():
+            lines.append(f'\nThread {names.get(tid, tid)}:\n')
+            lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+        lines.append(self.report())
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        self.logger.info(f'Wrote thread stacks and profile to {path}')
+
+    # internal functions
+    def _reset(self):
+        self.samples = 0
+        # code object -> samples at the top of a stack, anywhere in a stack
+        self.own     = collections.Counter()
+        self.total   = collections.Counter()
+        # thread name -> samples
+        self.threads = collections.Counter()
+        self.started = None
+        self.elapsed = 0
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names  = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for tid, frame in frames.items():
+                    if tid == me:
+                        continue
+                    self.threads[names.get(tid, str(tid))] += 1
+                    self.own[frame.f_code] += 1
+                    # recursive functions count once per stack
+                    seen = set()
+                    while frame:
+                        code = frame.f_code
+                        if code not in seen:
+                            seen.add(code)
+                            self.total[code] += 1
+                        frame = frame.f_back
+
+def _function(code):
+    return f'{code.co_filename}:{code.co_firstlineno}({code.co_name})'
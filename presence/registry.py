@@ -0,0 +1,85 @@
+import itertools
+import threading
+
+# connected clients, indexed by connection id and by remote JID
+class ClientRegistry(object):
+    def __init__(self):
+        super(ClientRegistry,self).__init__()
+        self.lock    = threading.Lock()
+        self.ids     = itertools.count(1)
+        self.by_id   = {}
+        self.by_jid  = {}
+        self.by_name = {}
+        # cached tuple for iteration, rebuilt after membership changes
+        self.snapshot = ()
+        self.dirty    = False
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        if self.dirty:
+            with self.lock:
+                self.snapshot = tuple(self.by_id.values())
+                self.dirty = False
+        return iter(self.snapshot)
+
+    # public interface
+    def add(self, client):
+        with self.lock:
+            client.conn_id = next(self.ids)
+            self.by_id[client.conn_id] = client
+            self._index(client)
+            self.dirty = True
+        return client.conn_id
+
+    def remove(self, client):
+        with self.lock:
+            if self.by_id.pop(client.conn_id, None) is None:
+                return
+            self._unindex(client)
+            self.dirty = True
+
+    # (re-)index a client after its remote JID became known
+    def update(self, client):
+        with self.lock:
+            if client.conn_id not in self.by_id:
+                return
+            self._unindex(client)
+            self._index(client)
+
+    def get(self, conn_id):
+        return self.by_id.get(conn_id, None)
+
+    # look up by full JID or by its local part
+    def lookup(self, jid):
+        with self.lock:
+            clients = self.by_jid.get(jid, None) or self.by_name.get(jid, {})
+            return list(clients.values())
+
+    def clear(self):
+        with self.lock:
+            self.by_id.clear()
+            self.by_jid.clear()
+            self.by_name.clear()
+            self.dirty = True
+
+    # internal functions
+    def _index(self, client):
+        client.registered_jid = client.other
+        if not client.other:
+            return
+        name = client.other.split('@')[0]
+        self.by_jid.setdefault(client.other, {})[client.conn_id] = client
+        self.by_name.setdefault(name, {})[client.conn_id] = client
+
+    def _unindex(self, client):
+        jid = client.registered_jid
+        if not jid:
+            return
+        for index, key in ((self.by_jid, jid),
+                           (self.by_name, jid.split('@')[0])):
+            clients = index.get(key, {})
+            clients.pop(client.conn_id, None)
+            if not len(clients):
+                index.pop(key, None)
@@ -1,58 +1,258 @@
+import asyncio
+import html
 import logging
 import socket
-import threading
+import time
 
-from .client import ClientThread
-from .types  import Message
+from .client    import AsyncClient, ClientThread
+from .commands  import CommandCache, CommandRunner
+from .listing   import DirectoryIndex
+from .metrics   import Metrics
+from .registry  import ClientRegistry
+from .transfers import TransferManager
+from .types     import Message, ResultTypeStr
 
 # main class
 class PresenceServer(object):
-    def __init__(self, address='', port=5298, logger=logging.getLogger()):
+    def __init__(self, address='', port=5298, logger=logging.getLogger(),
+                 reuseport=False, poolsize=4, cachesize=128, metrics=None,
+                 transferpool=2, transferqueue=16):
         super(PresenceServer,self).__init__()
-        self.address = address
-        self.port    = port
-        self.logger  = logger
+        self.address   = address
+        self.port      = port
+        self.logger    = logger
+        self.reuseport = reuseport
         
-        self.serversocket  = None
-        self.clientthreads = []
-        self.lock = threading.Lock()
+        self.serversocket = None
+        self.clients      = ClientRegistry()
+        self.runner       = CommandRunner(poolsize, logger=self.logger)
+        self.cache        = CommandCache(cachesize, logger=self.logger)
+        self.listing      = DirectoryIndex(logger=self.logger)
+        self.transfers    = TransferManager(
+            transferpool, transferqueue, logger=self.logger
+        )
+        self.client_args  = None
+
+        self.metrics = metrics or Metrics(enabled=False, logger=self.logger)
+        self.metrics.gauge(
+            'presence_clients', 'connected clients',
+            func=lambda: len(self.clients)
+        )
+        self.metrics.gauge(
+            'presence_transfers_pending', 'queued and running file transfers',
+            func=lambda: len(self.transfers)
+        )
+        self.connections = self.metrics.counter(
+            'presence_connections_total', 'accepted connections'
+        )
+        self.fanout_time = self.metrics.histogram(
+            'presence_broadcast_seconds', 'time to queue a broadcast'
+            ' for all recipients'
+        )
+
+        # message bus shared with other worker processes
+        self.bus         = None
+        self.remote_jids = {}
     
     # client callbacks
     def _client_stopped(self, client):
-        with self.lock:
-            self.clientthreads.remove(client)
+        self.clients.remove(client)
+        self._publish_roster()
+
+    def _client_identified(self, client):
+        self.clients.update(client)
+        self._publish_roster()
+
+    def _connect_client(self, client):
+        client.cleanup_func   = self._client_stopped
+        client.broadcast_func = self._broadcast
+        client.direct_func    = self._direct
+        client.identify_func  = self._client_identified
+        client.runner         = self.runner
+        client.cache          = self.cache
+        client.listing        = self.listing
+        client.transfers      = self.transfers
+        self.connections.inc()
 
     def _broadcast(self,client,message):
         self.logger.debug(f'Broadcasting message from "{message.identity}"')
-        with self.lock:
-            clientthreads = self.clientthreads[:]
-        for ct in clientthreads:
-            if ct == client:
+        # render once, recipients only differ in the envelope
+        m = Message()
+        if len(message.html):
+            m.html  = f"<b>{message.other}:</b> {message.html}"
+            m.text  = f"{message.other}: {message.text}"
+        if len(message.ascii):
+            m.ascii = f"{message.other}: {message.ascii}"
+        if self.metrics.enabled:
+            start = time.perf_counter()
+            self._deliver(m, self.clients, exclude=client)
+            self.fanout_time.observe(time.perf_counter() - start)
+        else:
+            self._deliver(m, self.clients, exclude=client)
+        if self.bus:
+            self.bus.publish(
+                {'type': 'broadcast', 'html': m.html, 'ascii': m.ascii}
+            )
+
+    def _direct(self,client,user,text):
+        recipients = self.clients.lookup(user)
+        if not len(recipients) and not self._is_remote_user(user):
+            client.send_html(f'Unknown user <b>{html.escape(user)}</b>')
+            return
+        self.logger.debug(f'Direct message from "{client.other}" to "{user}"')
+        m = Message(
+            html=f"<b>{client.other} (direct):</b> {html.escape(text)}",
+            ascii=f"{client.other} (direct): {text}",
+        )
+        self._deliver(m, recipients)
+        if self.bus:
+            self.bus.publish(
+                {'type': 'direct', 'user': user,
+                 'html': m.html, 'ascii': m.ascii}
+            )
+
+    def _deliver(self, message, recipients, exclude=None):
+        payload = None
+        for ct in recipients:
+            if ct == exclude:
                 continue
-            m = Message(identity=ct.identity,other=ct.other)
-            if len(message.html):
-                m.html  = f"<b>{message.other}:</b> {message.html}"
-            if len(message.ascii):
-                m.ascii = f"{message.other}: {message.ascii}"
-            ct.send_message(m)
+            if payload is None:
+                payload = ClientThread.render_payload(message)
+            ct.send_payload(payload)
+
+    # message bus
+    def attach_bus(self, bus):
+        self.bus = bus
+        self.bus.handler = self._bus_received
+        self.bus.publish({'type': 'hello'})
+
+    def _publish_roster(self):
+        if not self.bus:
+            return
+        jids = [ct.other for ct in self.clients if ct.other]
+        self.bus.publish({'type': 'roster', 'jids': jids})
+
+    def _is_remote_user(self, user):
+        for jids in list(self.remote_jids.values()):
+            for jid in jids:
+                if user == jid or user == jid.split('@')[0]:
+                    return True
+        return False
+
+    def _bus_received(self, msg):
+        kind = msg.get('type', None)
+        if kind == 'hello':
+            self._publish_roster()
+        elif kind == 'roster':
+            self.remote_jids[msg['worker']] = msg['jids']
+        elif kind == 'gone':
+            self.remote_jids.pop(msg['worker'], None)
+        elif kind == 'broadcast':
+            m = Message(html=msg['html'], ascii=msg['ascii'])
+            self._deliver(m, self.clients)
+        elif kind == 'direct':
+            m = Message(html=msg['html'], ascii=msg['ascii'])
+            self._deliver(m, self.clients.lookup(msg['user']))
+        else:
+            self.logger.warning(f'Unknown bus message type "{kind}"')
 
     # server commands
     def _users(self,client,message):
-        with self.lock:
-            clientthreads = self.clientthreads[:]
         users = []
-        for ct in clientthreads:
+        for ct in self.clients:
             users.append(ct.other)
+        for jids in list(self.remote_jids.values()):
+            users.extend(jids)
         client.send_html("<b>users:</b><br/>" + '<br/>'.join(users))
 
+    def _stats(self,client,message):
+        if not self.metrics.enabled:
+            client.send_html('Statistics disabled')
+            return
+        lines = ['<b>stats:</b><br/>']
+        for m in self.metrics:
+            labels = ','.join(f'{k}={v}' for k, v in m.labels.items())
+            name = f'{m.name}{{{labels}}}' if labels else m.name
+            if m.kind == 'histogram':
+                count, total, _ = m.get()
+                mean = 1000 * total / count if count else 0
+                value = f'{count} (avg {mean:.2f} ms)'
+            else:
+                value = m.get()
+            lines.append(f'  {html.escape(name)} {value}<br/>')
+        # connections of this server only, other workers keep their own
+        lines.append('<b>per user:</b><br/>')
+        for ct in self.clients:
+            results = ','.join(
+                f'{ResultTypeStr[t]}={n}'
+                for t, n in enumerate(ct.parser.counts) if n
+            )
+            lines.append(
+                f'  {html.escape(str(ct.other))} in {ct.cs.received}'
+                f' out {ct.cs.sent} results {results or "-"}<br/>'
+            )
+        client.send_html(''.join(lines))
+
+    def _transfers(self,client,message):
+        jobs = self.transfers.list_jobs()
+        if not len(jobs):
+            client.send_html('No file transfers')
+            return
+        client.send_html("<b>transfers:</b><br/>" + '<br/>'.join(
+            html.escape(job.describe()) for job in jobs
+        ))
+
+    def _cancel(self,client,message):
+        words = message.ascii.split()
+        if len(words) != 2 or not words[1].isdigit():
+            client.send_html('usage: cancel &lt;id&gt;')
+            return
+        job = self.transfers.get(int(words[1]))
+        # only the sender may cancel a transfer
+        if not job or job.other != client.other:
+            client.send_html(f'No active transfer {words[1]}')
+            return
+        self.transfers.cancel(job.id)
+        client.send_html(f'Cancelling transfer {job.id}')
+
     def _server_commands(self):
         return {
             'users': ClientThread.make_command(
                 func=self._users,
-                helptext="print list of connected users"
-                )
+                helptext="print list of connected users",
+                inline=True
+                ),
+            'stats': ClientThread.make_command(
+                func=self._stats,
+                helptext="print server statistics",
+                inline=True
+                ),
+            'transfers': ClientThread.make_command(
+                func=self._transfers,
+                helptext="print file transfers",
+                inline=True
+                ),
+            'cancel': ClientThread.make_command(
+                func=self._cancel,
+                helptext="cancel a file transfer, cancel <id>",
+                greedy=True, inline=True
+                ),
         }
 
+    # the command registry is built on the first connect and then shared
+    def _client_args(self,client_args):
+        if self.client_args is None:
+            commands = dict(client_args.get('commands', {}))
+            commands.update(self._server_commands())
+            args = dict(client_args)
+            args['metrics']  = self.metrics
+            args['commands'] = ClientThread.build_commands(
+                commands, client_args.get('aliases', {}),
+                prefixlen=client_args.get('prefixlen', 2)
+            )
+            self.client_args = args
+        return self.client_args
+
     # public interface
     def listen(self):
         if self.serversocket:
@@ -62,34 +262,80 @@ class PresenceServer(object):
 
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            # lets several worker processes accept on the same port
+            self.serversocket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1
+            )
         self.serversocket.bind((self.address, self.port))
-        self.serversocket.listen(5)
+        self.serversocket.listen(socket.SOMAXCONN)
     
     def wait_for_connect(self,client_args={}):
         (clientsocket, address) = self.serversocket.accept()
         self.logger.info(f"Starting client thread {address[0]}:{address[1]}")
-        commands = self._server_commands()
-        args = dict(client_args)
-        if 'commands' in args:
-            args['commands'].update(commands)
-        else:
-            args['commands'] = commands
+        args = self._client_args(client_args)
         ct = ClientThread(
             sock=clientsocket, address=address, logger=self.logger, args=args
         )
-        ct.cleanup_func   = self._client_stopped
-        ct.broadcast_func = self._broadcast
-        with self.lock:
-            self.clientthreads.append(ct)
+        self._connect_client(ct)
+        self.clients.add(ct)
         ct.start()
         
     def cleanup(self):
-        with self.lock:
-            clientthreads = self.clientthreads[:]
-        for ct in clientthreads:
+        for ct in self.clients:
             ct.stop()
             ct.join()
+        self.runner.shutdown()
+        self.transfers.shutdown()
         if self.serversocket:
             self.logger.info('Closing server socket')
             self.serversocket.close()
-            
+
+# single-threaded server running all clients on an asyncio event loop
+class AsyncPresenceServer(PresenceServer):
+    def __init__(self, address='', port=5298, logger=logging.getLogger(),
+                 reuseport=False, poolsize=4, cachesize=128, metrics=None,
+                 transferpool=2, transferqueue=16):
+        super(AsyncPresenceServer,self).__init__(
+            address=address, port=port, logger=logger, reuseport=reuseport,
+            poolsize=poolsize, cachesize=cachesize, metrics=metrics,
+            transferpool=transferpool, transferqueue=transferqueue
+        )
+        self.loop = None
+
+    # client callbacks
+    def _client_started(self, client):
+        self.clients.add(client)
+
+    def _create_client(self, client_args):
+        ac = AsyncClient(
+            self.loop, logger=self.logger, args=self._client_args(client_args)
+        )
+        self._connect_client(ac)
+        ac.startup_func = self._client_started
+        return ac
+
+    # public interface
+    async def serve(self, client_args={}):
+        self.loop = asyncio.get_running_loop()
+        self.listen()
+        server = await self.loop.create_server(
+            lambda: self._create_client(client_args), sock=self.serversocket
+        )
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.cleanup()
+
+    def serve_forever(self, client_args={}):
+        asyncio.run(self.serve(client_args))
+
+    def cleanup(self):
+        for ac in self.clients:
+            ac.stop()
+        self.clients.clear()
+        self.runner.shutdown()
+        self.transfers.shutdown()
+        self.serversocket = None
+        self.logger.info('Closing server socket')
@@ -1,36 +1,327 @@
+import asyncio
+import collections
 import logging
 import socket
+import threading
+
+from .metrics import Metrics
+
+# traffic counters shared by all client sockets
+def _byte_counters(metrics):
+    metrics = metrics or Metrics(enabled=False)
+    return (
+        metrics.counter(
+            'presence_received_bytes_total', 'bytes read from clients'),
+        metrics.counter(
+            'presence_sent_bytes_total', 'bytes written to clients'),
+    )
+
+# policies for full outbound queues
+class Overflow:
+    DROP_OLDEST = 'drop-oldest'
+    DISCONNECT  = 'disconnect'
+
+# bounded queue of encoded stanzas waiting to be written
+class OutboundQueue(object):
+    def __init__(self, maxsize=256, overflow=Overflow.DROP_OLDEST,
+                 logger=logging.getLogger()):
+        super(OutboundQueue,self).__init__()
+        if overflow not in (Overflow.DROP_OLDEST, Overflow.DISCONNECT):
+            raise ValueError(f'Unknown overflow policy "{overflow}"')
+        self.maxsize  = maxsize
+        self.overflow = overflow
+        self.logger   = logger
+        self.items    = collections.deque()
+        self.cond     = threading.Condition()
+        self.closed   = False
+        self.held     = False
+
+    def __len__(self):
+        return len(self.items)
+
+    # returns False if the consumer is too slow and should be disconnected
+    def put(self, item):
+        with self.cond:
+            if self.closed:
+                return True
+            if self.maxsize and len(self.items) >= self.maxsize:
+                if self.overflow == Overflow.DISCONNECT:
+                    self.logger.warning('Outbound queue full, disconnecting')
+                    self.items.clear()
+                    self.closed = True
+                    self.cond.notify()
+                    return False
+                self.logger.debug('Outbound queue full, dropping oldest')
+                self.items.popleft()
+            self.items.append(item)
+            self.cond.notify()
+        return True
+
+    # blocks until items are available and not held back, returns up to
+    # maxitems of them, or an empty list once closed and empty
+    def get_many(self, maxitems=64):
+        with self.cond:
+            while (not len(self.items) or self.held) and not self.closed:
+                self.cond.wait()
+            items = []
+            while len(self.items) and len(items) < maxitems:
+                items.append(self.items.popleft())
+            return items
+
+    def get_nowait(self):
+        with self.cond:
+            if not len(self.items):
+                return None
+            return self.items.popleft()
+
+    # items put while held are only handed out after release
+    def hold(self):
+        with self.cond:
+            self.held = True
+
+    def release(self):
+        with self.cond:
+            self.held = False
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
 
 # client socket wrapper
 class ClientSocket(object):
-    def __init__(self, sock, address, logger=logging.getLogger()):
+    def __init__(self, sock, address, logger=logging.getLogger(),
+                 queuesize=256, overflow=Overflow.DROP_OLDEST, readsize=16384,
+                 metrics=None):
         super(ClientSocket,self).__init__()
         self.sock = sock
         self.sock.settimeout(1)
         self.address = address[0]
         self.port    = address[1]
         self.logger = logger
-        
+        self.bytes_in, self.bytes_out = _byte_counters(metrics)
+        # traffic of this connection alone, shown per user by stats
+        self.received = 0
+        self.sent     = 0
+
+        # incoming data is read into a reused buffer
+        self.buffer = bytearray(readsize)
+        self.view   = memoryview(self.buffer)
+
+        # outgoing data is written by a dedicated thread
+        self.queue  = OutboundQueue(queuesize, overflow, logger=self.logger)
+        self.broken = False
+        self.writer = threading.Thread(
+            target=self._write_loop,
+            name=f'writer-{self.address}:{self.port}',
+            daemon=True,
+        )
+        self.writer.start()
+
     def close(self):
         self.logger.info(f'Closing connection to {self.address}:{self.port}')
+        self.queue.close()
+        if self.writer is not threading.current_thread():
+            self.writer.join(5)
         self.sock.close()
-        
+
     def send_line(self, msg):
         self.send(msg + '\n')
 
     def send(self, msg):
-        totalsent = 0
-        bmsg = msg.encode()
-        while totalsent < len(bmsg):
-            sent = self.sock.send(bmsg[totalsent:])
-            if sent == 0:
-                raise RuntimeError("socket connection broken")
-            self.logger.debug(f'WRITE {repr(bmsg[totalsent:totalsent+sent])}')
-            totalsent = totalsent + sent
+        self.send_bytes(msg.encode())
+
+    def send_bytes(self, bmsg):
+        if self.broken:
+            return
+        if not self.queue.put(bmsg):
+            self._disconnect()
+
+    # collect outgoing data until flush, then write it with a single syscall
+    def cork(self):
+        self.queue.hold()
 
+    def flush(self):
+        self.queue.release()
+
+    # the returned view is only valid until the next call
     def recv(self):
-        chunk = self.sock.recv(2048)
-        self.logger.debug(f'READ  {repr(chunk)}')
-        if chunk == '':
+        nbytes = self.sock.recv_into(self.buffer)
+        if not nbytes:
             raise RuntimeError("socket connection broken")
+        self.bytes_in.inc(nbytes)
+        self.received += nbytes
+        chunk = self.view[:nbytes]
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'READ  {repr(bytes(chunk))}')
+        return chunk
+
+    # internal functions
+    def _disconnect(self):
+        # wakes up the reading thread, which then shuts down the client
+        self.broken = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        buffers = self.queue.get_many()
+        while len(buffers):
+            try:
+                self._sendall(buffers)
+            except (OSError, RuntimeError) as e:
+                self.logger.debug(f'Write failed: {e}')
+                self.queue.close()
+                self._disconnect()
+                return
+            buffers = self.queue.get_many()
+
+    def _sendall(self, buffers):
+        buffers = [memoryview(b) for b in buffers]
+        while len(buffers):
+            try:
+                sent = self.sock.sendmsg(buffers)
+            except socket.timeout:
+                continue
+            if sent == 0:
+                raise RuntimeError("socket connection broken")
+            self.bytes_out.inc(sent)
+            self.sent += sent
+            if self.logger.isEnabledFor(logging.DEBUG):
+                data = b''.join(buffers)[:sent]
+                self.logger.debug(f'WRITE {repr(data)}')
+            # drop what was written, without copying the rest
+            while sent and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
+# asyncio transport wrapper with the same interface as ClientSocket
+class AsyncClientSocket(object):
+    def __init__(self, transport, loop, logger=logging.getLogger(),
+                 queuesize=256, overflow=Overflow.DROP_OLDEST, readsize=16384,
+                 metrics=None):
+        super(AsyncClientSocket,self).__init__()
+        self.transport = transport
+        self.loop      = loop
+        address = transport.get_extra_info('peername')
+        self.address = address[0]
+        self.port    = address[1]
+        self.logger = logger
+        self.bytes_in, self.bytes_out = _byte_counters(metrics)
+        # traffic of this connection alone, shown per user by stats
+        self.received = 0
+        self.sent     = 0
+
+        # data is held back here while the transport is paused
+        self.queue  = OutboundQueue(queuesize, overflow, logger=self.logger)
+        self.paused = False
+
+        # data collected while corked
+        self.corked  = False
+        self.pending = []
+
+        # the transport reads directly into this buffer
+        self.buffer = bytearray(readsize)
+        self.view   = memoryview(self.buffer)
+
+    def close(self):
+        self.logger.info(f'Closing connection to {self.address}:{self.port}')
+        self._call(self._close)
+
+    def send_line(self, msg):
+        self.send(msg + '\n')
+
+    def send(self, msg):
+        self.send_bytes(msg.encode())
+
+    def send_bytes(self, bmsg):
+        self._call(self._write, bmsg)
+
+    # collect outgoing data until flush, then write it at once
+    def cork(self):
+        self.corked = True
+
+    def flush(self):
+        self.corked = False
+        if not len(self.pending):
+            return
+        pending = self.pending
+        self.pending = []
+        if self.transport.is_closing():
+            return
+        if self.paused:
+            for bmsg in pending:
+                if not self.queue.put(bmsg):
+                    self.transport.abort()
+                    return
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'WRITE {repr(b"".join(pending))}')
+        nbytes = sum(len(bmsg) for bmsg in pending)
+        self.bytes_out.inc(nbytes)
+        self.sent += nbytes
+        self.transport.writelines(pending)
+
+    # buffer protocol, called by the protocol
+    def get_buffer(self):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        self.bytes_in.inc(nbytes)
+        self.received += nbytes
+        chunk = self.view[:nbytes]
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'READ  {repr(bytes(chunk))}')
         return chunk
+
+    # flow control, called by the protocol
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        # writing may pause the transport again, keep the rest queued
+        while not self.paused and not self.transport.is_closing():
+            bmsg = self.queue.get_nowait()
+            if bmsg is None:
+                break
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f'WRITE {repr(bmsg)}')
+            self.bytes_out.inc(len(bmsg))
+            self.sent += len(bmsg)
+            self.transport.write(bmsg)
+
+    # internal functions
+    def _close(self):
+        self.flush()
+        self.transport.close()
+
+    def _write(self, bmsg):
+        if self.transport.is_closing():
+            return
+        if self.corked:
+            self.pending.append(bmsg)
+            return
+        if self.paused:
+            if not self.queue.put(bmsg):
+                self.transport.abort()
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'WRITE {repr(bmsg)}')
+        self.bytes_out.inc(len(bmsg))
+        self.sent += len(bmsg)
+        self.transport.write(bmsg)
+
+    # transfers run in executor threads, marshal calls into the loop
+    def _call(self, func, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
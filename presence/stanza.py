@@ -0,0 +1,106 @@
+import html
+import string
+
+# outgoing XML, templates are parsed once at import time and rendered
+# straight to bytes for the client sockets
+class Template(object):
+    def __init__(self, template, raw=()):
+        super(Template,self).__init__()
+        # values of raw fields are trusted markup and inserted as is
+        self.raw = frozenset(raw)
+        # (literal text, field name or None)
+        self.parts = tuple(
+            (literal, field)
+            for literal, field, _, _ in string.Formatter().parse(template)
+        )
+
+    def render(self, **values):
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if field not in self.raw:
+                value = html.escape(str(value))
+            out.append(value)
+        return ''.join(out).encode()
+
+STREAMS_NS  = 'urn:ietf:params:xml:ns:xmpp-streams'
+STANZAS_NS  = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+
+STREAM_OPEN = Template(
+    "<stream:stream xmlns='jabber:client'"
+    " xmlns:stream='http://etherx.jabber.org/streams'"
+    " from='{identity}' to='{other}' version='1.0'>\n"
+)
+
+STREAM_CLOSE = b'</stream:stream>\n'
+
+STREAM_ERROR = Template(
+    "<stream:error><{condition} xmlns='" + STREAMS_NS + "'/>"
+    "</stream:error>\n",
+    raw=('condition',)
+)
+
+# a chat message is sent as envelope plus payload, so the payload can
+# be rendered once for all recipients
+MESSAGE_START = Template(
+    "<message from='{identity}' to='{other}' type='chat'>"
+)
+
+MESSAGE_PAYLOAD = Template(
+    "<body>{text}</body>"
+    "<html xmlns='http://www.w3.org/1999/xhtml'>"
+    "<body>{html}</body>"
+    "</html></message>\n",
+    raw=('html',)
+)
+
+SI_RESULT = Template(
+    "<iq type='result' from='{identity}' to='{other}' id='{id}'>"
+    "<si xmlns='http://jabber.org/protocol/si'>"
+    "<feature xmlns='http://jabber.org/protocol/feature-neg'>"
+    "<x xmlns='jabber:x:data' type='submit'>"
+    "<field var='stream-method'>"
+    "<value>http://jabber.org/protocol/bytestreams</value>"
+    "</field></x></feature></si></iq>\n"
+)
+
+# asks the sender to skip the first offset bytes of the file (XEP-0096)
+SI_RESULT_RANGE = Template(
+    "<iq type='result' from='{identity}' to='{other}' id='{id}'>"
+    "<si xmlns='http://jabber.org/protocol/si'>"
+    "<file xmlns='http://jabber.org/protocol/si/profile/file-transfer'>"
+    "<range offset='{offset}'/></file>"
+    "<feature xmlns='http://jabber.org/protocol/feature-neg'>"
+    "<x xmlns='jabber:x:data' type='submit'>"
+    "<field var='stream-method'>"
+    "<value>http://jabber.org/protocol/bytestreams</value>"
+    "</field></x></feature></si></iq>\n"
+)
+
+IQ_RESULT = Template(
+    "<iq type='result' from='{identity}' to='{other}' id='{id}'/>\n"
+)
+
+STREAMHOST_USED = Template(
+    "<iq type='result' from='{identity}' to='{other}' id='{id}'>"
+    "<query xmlns='http://jabber.org/protocol/bytestreams' sid='{sid}'>"
+    "<streamhost-used jid='{jid}'/></query></iq>\n"
+)
+
+IQ_NOT_ACCEPTABLE = Template(
+    "<iq type='error' from='{identity}' to='{other}' id='{id}'>"
+    "<error type='modify'>"
+    "<not-acceptable xmlns='" + STANZAS_NS + "'/>"
+    "</error></iq>\n"
+)
+
+OOB_ERROR = Template(
+    "<iq type='error' from='{identity}' to='{other}' id='{id}'>"
+    "<query xmlns='jabber:iq:oob'><url>{url}</url></query>"
+    "<error code='{code}' type='{type}'>"
+    "<{condition} xmlns='" + STANZAS_NS + "'/></error></iq>\n",
+    raw=('condition',)
+)
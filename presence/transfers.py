@@ -0,0 +1,135 @@
+import collections
+import concurrent.futures
+import html
+import itertools
+import logging
+import os
+import threading
+import time
+
+# states of a transfer job
+class TransferState:
+    QUEUED    = 'queued'
+    RUNNING   = 'running'
+    DONE      = 'done'
+    FAILED    = 'failed'
+    CANCELLED = 'cancelled'
+
+# a file transfer handed to the transfer manager
+class TransferJob(object):
+    def __init__(self, id, client, transfer):
+        super(TransferJob,self).__init__()
+        self.id       = id
+        self.client   = client
+        self.transfer = transfer
+        self.name     = os.path.basename(transfer.filename or '')
+        self.other    = client.other
+        self.state    = TransferState.QUEUED
+        self.future   = None
+        self.started  = None
+        self.finished = None
+
+    @property
+    def progress(self):
+        return self.transfer.received, int(self.transfer.filesize or 0)
+
+    def describe(self):
+        received, total = self.progress
+        percent = f' {100 * received // total}%' if total else ''
+        elapsed = ''
+        if self.started:
+            end = self.finished or time.monotonic()
+            elapsed = f', {end - self.started:.1f}s'
+        return (f'{self.id}: {self.name} from {self.other}'
+                f' - {self.state}{percent} ({received}/{total} bytes{elapsed})')
+
+# runs file transfers of all clients of a server on a bounded pool, with
+# a bounded number of waiting transfers
+class TransferManager(object):
+    def __init__(self, poolsize=2, queuesize=16, logger=logging.getLogger()):
+        super(TransferManager,self).__init__()
+        self.poolsize  = poolsize
+        self.queuesize = queuesize
+        self.logger    = logger
+        self.executor  = concurrent.futures.ThreadPoolExecutor(
+            max_workers=poolsize, thread_name_prefix='transfer'
+        )
+        self.lock = threading.Lock()
+        self.ids  = itertools.count(1)
+        # id -> job, for queued and running transfers
+        self.jobs = {}
+        # most recently finished transfers
+        self.history = collections.deque(maxlen=16)
+
+    def __len__(self):
+        return len(self.jobs)
+
+    # public interface
+    # returns the job, or None if the pool and the queue are full
+    def submit(self, client, transfer):
+        with self.lock:
+            if len(self.jobs) >= self.poolsize + self.queuesize:
+                return None
+            job = TransferJob(next(self.ids), client, transfer)
+            self.jobs[job.id] = job
+            job.future = self.executor.submit(self._run, job)
+        self.logger.info(f'Queued transfer {job.id}: {job.name}')
+        return job
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id, None)
+
+    # active jobs first, then finished ones, newest first
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values()) + list(reversed(self.history))
+
+    def cancel(self, id):
+        with self.lock:
+            job = self.jobs.get(id, None)
+        if not job:
+            return False
+        self.logger.info(f'Cancelling transfer {id}')
+        job.transfer.cancel(discard=True)
+        if job.future.cancel():
+            # never started
+            self._finish(job, TransferState.CANCELLED)
+        return True
+
+    # partial files of interrupted transfers are kept for resuming
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.transfer.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # internal functions
+    def _run(self, job):
+        job.state   = TransferState.RUNNING
+        job.started = time.monotonic()
+        status = False
+        try:
+            status = job.client.retrieve_transfer(job.transfer)
+        except Exception as e:
+            self.logger.error(f'Transfer {job.id} failed: {e!r}')
+        if job.transfer.cancelled:
+            state = TransferState.CANCELLED
+        elif status:
+            state = TransferState.DONE
+        else:
+            state = TransferState.FAILED
+        self._finish(job, state)
+        checksum = ''
+        if state == TransferState.DONE and job.transfer.sha256:
+            checksum = f'<br/>sha256 {job.transfer.sha256}'
+        job.client.send_html(
+            f'Transfer {job.id} of <b>{html.escape(job.name)}</b>: {state}'
+            f'{checksum}'
+        )
+
+    def _finish(self, job, state):
+        job.state    = state
+        job.finished = time.monotonic()
+        with self.lock:
+            if self.jobs.pop(job.id, None):
+                self.history.append(job)
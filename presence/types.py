@@ -1,9 +1,19 @@
 import hashlib
 import os
-import shutil
+import queue
+import re
 import socket
-import tempfile
-from urllib.request import urlopen
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree
+
+from .         import stanza
+from .download import DownloadError, HttpDownloader
+from .partial  import PartialFile
+
+# seconds between checks for a cancel while waiting for streamhosts
+CANCELPOLL = 0.1
 
 # parser result type
 ResultTypeStr = [
@@ -11,7 +21,8 @@ ResultTypeStr = [
     'STREAM_CLOSE',
     'MESSAGE',
     'FILE_TRANSFER',
-    'FEATURE_NEG'
+    'FEATURE_NEG',
+    'STREAM_ERROR',
 ]
 
 ResultType = type('ResultType', (object,), {
@@ -47,27 +58,80 @@ class Stream(object):
         self.identity = identity
         self.other    = other
         
+# plain text of an html fragment, line breaks become newlines
+def html_to_text(html):
+    if not len(html):
+        return ''
+    html = re.sub(r'<br\s*/?>', '\n', html)
+    return ''.join(
+        xml.etree.ElementTree.fromstring(f'<p>{html}</p>').itertext()
+    ).strip()
+
 # text/html message
 class Message(object):
-    def __init__(self, html='', ascii='', identity=None, other=None):
+    def __init__(self, html='', ascii='', identity=None, other=None,
+                 text=None):
         super(Message,self).__init__()
         self.html     = html
         self.ascii    = ascii
         self.identity = identity
         self.other    = other
+        self._text    = text
+
+    # plain text of html, set by the parser or derived on first access
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = html_to_text(self.html)
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+
+    @property
+    def is_empty(self):
+        return not len(self.ascii.strip()) and not len(self.text)
 
 # feature negotiation
 class FeatureNeg(object):
-    def __init__(self, iq_id):
+    def __init__(self, iq_id, other=None, filename=None, filesize=None,
+                 ranges=False):
         super(FeatureNeg,self).__init__()
         self.iq_id = iq_id
         self.option_values = []
+        # the SI file offer being negotiated
+        self.other    = other
+        self.filename = filename
+        self.filesize = filesize
+        self.ranges   = ranges
+
+# bytes read per call when receiving files
+CHUNKSIZE = 1 << 20
+
+def _recv_exact(sock, nbytes):
+    data = b''
+    while len(data) < nbytes:
+        chunk = sock.recv(nbytes - len(data))
+        if not len(chunk):
+            raise ConnectionError("connection closed by streamhost")
+        data += chunk
+    return data
 
 # file transfer
 class Transfer(object):
     def __init__(self, parent, **kwargs):
         super(Transfer,self).__init__()
         self.__dict__['logger'] = parent.logger
+        # bytes received so far, set while retrieving
+        self.__dict__['received'] = 0
+        self.__dict__['_cancel']  = threading.Event()
+        # partial data of a cancelled transfer is deleted, not kept
+        self.__dict__['_discard'] = False
+        # SHA-256 of the received file, set once it is complete
+        self.__dict__['sha256']   = ''
+        # connection of a running transfer, closed on cancel
+        self.__dict__['_conn']    = None
         self._add_vars(['filename','filesize', 'identity', 'other'])
         for k,v in kwargs.items():
             self.__setattr__(k,v)
@@ -80,6 +144,42 @@ class Transfer(object):
             return
         super(Transfer,self).__setattr__(key,val)
 
+    # stops a running transfer from another thread, the data received so
+    # far is kept for resuming unless discard is set
+    def cancel(self, discard=False):
+        self.__dict__['_discard'] = discard
+        self._cancel.set()
+        conn = self._conn
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    # path in downloaddir the file is stored under, None if the offered
+    # name is unusable
+    def _destination(self, downloaddir, name=None):
+        name = os.path.basename(name or self.filename)
+        if name in ('', '.', '..'):
+            self.logger.error(f'Invalid file name "{self.filename}"')
+            return None
+        return os.path.join(downloaddir, name)
+
+    # keeps the partial file of a failed transfer for the next attempt
+    def _interrupted(self, partial):
+        if self.cancelled and self._discard:
+            partial.discard()
+            return
+        partial.close()
+        if partial.done:
+            self.logger.info(
+                f'Keeping {partial.done} bytes of {self.filename} for resuming'
+            )
+
     def _add_vars(self,varlist):
         for var in varlist:
             self.__dict__[var] = None
@@ -98,132 +198,247 @@ class Transfer(object):
 class Transfer_SOCKS5(Transfer):
     def __init__(self, parent, **kwargs):
         self._add_vars(['iq_id', 'sid', 'streamhosts' ])
+        # the sender accepts ranged transfers (XEP-0096), so the data of
+        # an earlier attempt is kept and only the rest is sent
+        self.__dict__['ranges'] = False
         super(Transfer_SOCKS5,self).__init__(parent, **kwargs)
         
-    def retrieve(self, clientsocket, downloaddir):
+    # options: 'timeout' for connecting, the SOCKS5 handshake and idle
+    # reads, 'stagger' seconds between connection attempts
+    def retrieve(self, clientsocket, downloaddir, options={}):
         if not self._is_valid():
             return False
-        
-        status = False
-        for host in self.streamhosts:
-            status = self._get_file_socks5(host, downloaddir)
-            if status:
-                break
-        return status
+        timeout = options.get('timeout', 30)
+        stagger = options.get('stagger', 0.25)
+        connected = self._connect_streamhosts(timeout, stagger)
+        if not connected:
+            self.logger.error(f'No usable streamhost for {self.filename}')
+            return False
+        sock, streamhost = connected
+        self._conn = sock
+        try:
+            if self.cancelled:
+                return False
+            # tell the initiator which streamhost to send the data over
+            clientsocket.send_bytes(stanza.STREAMHOST_USED.render(
+                identity=self.identity, other=self.other, id=self.iq_id,
+                sid=self.sid, jid=streamhost[2]
+            ))
+            return self._receive_file(sock, downloaddir)
+        except OSError as e:
+            self.logger.debug(f"{e}")
+            return False
+        finally:
+            self._conn = None
+            sock.close()
 
     def reject(self, cs):
-        cs.send_line(
-            f"<iq from='{self.identity}' id='{self.iq_id}' to='{self.other}'"
-            f" type='error'><error type='modify'>"
-            f"<not-acceptable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>"
-            f"</error></iq>"
-        )
+        cs.send_bytes(stanza.IQ_NOT_ACCEPTABLE.render(
+            identity=self.identity, other=self.other, id=self.iq_id
+        ))
+
+    # connects to the streamhosts in parallel, starting the next attempt
+    # after stagger seconds or as soon as one fails, and returns
+    # (socket, streamhost) of the first that completes the SOCKS5
+    # handshake; the other connections are closed
+    def _connect_streamhosts(self, timeout, stagger):
+        results = queue.Queue()
+        lock    = threading.Lock()
+        done    = []
+        def attempt(streamhost):
+            sock = self._attempt(streamhost, timeout)
+            with lock:
+                if sock and done:
+                    # lost the race
+                    sock.close()
+                    sock = None
+                if not done:
+                    results.put((sock, streamhost))
 
-    def _get_file_socks5(self, streamhost, downloaddir):
+        pending = list(self.streamhosts)
+        running = 0
+        winner  = None
+        while winner is None and (len(pending) or running):
+            if self.cancelled:
+                break
+            if len(pending):
+                threading.Thread(
+                    target=attempt, args=(pending.pop(0),),
+                    name='streamhost', daemon=True
+                ).start()
+                running += 1
+            wait = stagger if len(pending) else timeout
+            result = self._next_result(results, wait)
+            if result is None:
+                # cancelled, or start the next attempt; running ones end
+                # by themselves
+                continue
+            sock, streamhost = result
+            running -= 1
+            if sock:
+                winner = (sock, streamhost)
+        with lock:
+            done.append(True)
+            while not results.empty():
+                sock, _ = results.get()
+                if sock:
+                    sock.close()
+        if winner:
+            self.logger.debug(f'Using streamhost "{winner[1]}"')
+        return winner
+
+    # waits up to wait seconds for an attempt to end, in short slices so
+    # that a cancel is noticed; returns None if none ended or on cancel
+    def _next_result(self, results, wait):
+        deadline = time.monotonic() + wait
+        while not self.cancelled:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                return results.get(timeout=min(remaining, CANCELPOLL))
+            except queue.Empty:
+                pass
+        return None
+
+    # returns a socket that completed the SOCKS5 handshake, or None
+    def _attempt(self, streamhost, timeout):
         self.logger.debug(f'Connecting to "{streamhost}"')
-        target_jid = streamhost[2]
         try:
-            sock = socket.create_connection((streamhost[0],int(streamhost[1])))
-            # start SOCKS5 handshake
-            # send version identifier/method selection message
-            msg = bytearray([0x5, 0x0])
-            sock.send(msg)
-            # receive METHOD selection message from server
-            servermethods = sock.recv(2)
-            if len(servermethods) == 2 and ord(servermethods[0]) == 0x5 \
-               and ord(servermethods[1]) == 0x0:
-                # success
-                pass
-            else:
-                self.logger.error('SOCKS5 handshake failed')
-                return False
-            
-            # SHA1 Hash of: (SID + Requester JID + Target JID)
-            idhash = hashlib.sha1(f"{self.sid}{self.iq_id}{target_jid}")
-            # SOCKS5 request: VER, CMD, RSV, ATYP, DST.ADDR, DST.PORT
-            # VER = 0x05,
-            # CMD = [ CONNECT 0x01, BIND 0x02, UDP ASSOCIATE 0x03 ], RSV = 0x0
-            # ATYP = [ IPv4 address: 0x01,
-            #          DOMAINNAME: 0x03, IPv6 address: 0x04 ]
-            # DST.ADDR = Variable, DST.PORT = 0x0000 (2 bytes)
-            dst_addr = bytearray(idhash.digest())
-            msg = bytearray([0x05, 0x01, 0x00, 0x03, len(dst_addr)]) \
-                + dst_addr + bytearray([0x0,0x0])
-            sock.send(msg)
-            fd, fpath = tempfile.mkstemp()
-            f = os.fdopen(fd, "w")
-            self.logger.debug(f'Writing to "{fpath}"')
-            bytesread = 0
-            filesize = int(self.filesize)
-            read_reply = True
-            reply = ''
-            # SOCKS5 reply: VER, REP, RSV, ATYP, BND.ADDR, BND.PORT
-            # VER = 0x05,
-            # REP = [ 0x0 succeeded,
-            #         0x1 general SOCKS server failure,
-            #         0x2 connection not allowed by ruleset,
-            #         0x3 Network unreachable,
-            #         0x4 Host unreachable,
-            #         0x5 Connection refused,
-            #         0x6 TTL expired,
-            #         0x7 Command not supported
-            #         0x8 Address type not supported,
-            #         0x9 to X'FF' unassigned ], RSV = 0x0,
-            # ATYP = [ IPv4 address: 0x01,
-            #          DOMAINNAME: 0x03,
-            #          IPv6 address: 0x04 ],
-            # BND.ADDR = Variable, BND.PORT = 2 bytes
+            sock = socket.create_connection(
+                (streamhost[0],int(streamhost[1])), timeout=timeout
+            )
+        except (OSError, ValueError) as e:
+            self.logger.debug(f'Connecting to "{streamhost}" failed: {e}')
+            return None
+        try:
+            if self._socks5_connect(sock):
+                return sock
+        except OSError as e:
+            self.logger.debug(f'SOCKS5 with "{streamhost}" failed: {e}')
+        sock.close()
+        return None
+
+    def _socks5_connect(self, sock):
+        # start SOCKS5 handshake
+        # send version identifier/method selection message
+        sock.sendall(bytes([0x5, 0x1, 0x0]))
+        # receive METHOD selection message from server
+        if _recv_exact(sock, 2) != bytes([0x5, 0x0]):
+            self.logger.error('SOCKS5 handshake failed')
+            return False
+
+        # SHA1 Hash of: (SID + Requester JID + Target JID), hex encoded
+        idhash = hashlib.sha1(
+            f"{self.sid}{self.other}{self.identity}".encode()
+        )
+        # SOCKS5 request: VER, CMD, RSV, ATYP, DST.ADDR, DST.PORT
+        # VER = 0x05,
+        # CMD = [ CONNECT 0x01, BIND 0x02, UDP ASSOCIATE 0x03 ], RSV = 0x0
+        # ATYP = [ IPv4 address: 0x01,
+        #          DOMAINNAME: 0x03, IPv6 address: 0x04 ]
+        # DST.ADDR = Variable, DST.PORT = 0x0000 (2 bytes)
+        dst_addr = idhash.hexdigest().encode()
+        sock.sendall(
+            bytes([0x05, 0x01, 0x00, 0x03, len(dst_addr)])
+            + dst_addr + bytes([0x0,0x0])
+        )
+
+        # SOCKS5 reply: VER, REP, RSV, ATYP, BND.ADDR, BND.PORT
+        # VER = 0x05,
+        # REP = [ 0x0 succeeded,
+        #         0x1 general SOCKS server failure,
+        #         0x2 connection not allowed by ruleset,
+        #         0x3 Network unreachable,
+        #         0x4 Host unreachable,
+        #         0x5 Connection refused,
+        #         0x6 TTL expired,
+        #         0x7 Command not supported
+        #         0x8 Address type not supported,
+        #         0x9 to X'FF' unassigned ], RSV = 0x0,
+        # ATYP = [ IPv4 address: 0x01,
+        #          DOMAINNAME: 0x03,
+        #          IPv6 address: 0x04 ],
+        # BND.ADDR = Variable, BND.PORT = 2 bytes
+        reply = _recv_exact(sock, 4)
+        if reply[:3] != bytes([0x5, 0x0, 0x0]):
+            self.logger.error("Connection with SOCKS5 server failed")
+            return False
+        addr_type = reply[3]
+        if addr_type == 1:
+            length = 4
+        elif addr_type == 4:
+            length = 16
+        elif addr_type == 3:
+            length = _recv_exact(sock, 1)[0]
+        else:
+            self.logger.error("Error parsing SOCKS5 bind address")
+            return False
+        reply += _recv_exact(sock, length + 2)
+        self.logger.debug(f"SOCKS5 reply: {repr(reply)}")
+        return True
+
+    # streams the file into a partial file next to its destination, so
+    # completing it is a rename and every byte is written and hashed once;
+    # with ranges, the sender was asked to skip the data kept from an
+    # earlier attempt
+    def _receive_file(self, sock, downloaddir):
+        destfile = self._destination(downloaddir)
+        if not destfile:
+            return False
+        filesize = int(self.filesize)
+        partial  = si_partial(
+            destfile, self.other, self.filename, filesize, self.logger
+        )
+        try:
+            partial.open(restart=not self.ranges)
+        except FileExistsError as e:
+            self.logger.error(f"Transfer of {self.filename} refused: {e}")
+            return False
+        except OSError:
+            partial.close()
+            raise
+        offset = partial.prefix
+        self.logger.debug(f'Writing to "{partial.path}" at {offset}')
+        bytesread = offset
+        buffer = bytearray(CHUNKSIZE)
+        view   = memoryview(buffer)
+        try:
             while bytesread < filesize:
-                chunk = sock.recv(2048)
-                if not len(chunk):
+                nbytes = sock.recv_into(
+                    view[:min(CHUNKSIZE, filesize - bytesread)]
+                )
+                if not nbytes:
                     break
-                if read_reply:
-                    if len(chunk) < 7:
-                        self.logger.error(
-                            "Could not parse SOCKS5 message, chunk too short"
-                        )
-                        return False
-                    pos = 0
-                    if ord(chunk[pos]) != 0x5 or ord(chunk[pos+1]) != 0x0 \
-                       or ord(chunk[pos+2]) != 0x0:
-                        self.logger.error(
-                            "Connection with SOCKS5 server failed"
-                        )
-                        return False
-                    pos+=3
-                    addr_type = ord(chunk[pos])
-                    pos+=1
-                    if addr_type == 1 or addr_type == 4:
-                        # IPv4 or IPv6
-                        pos += 4*addr_type
-                    elif addr_type == 3:
-                        # domainname
-                        length = ord(chunk[pos])
-                        pos += 1 + length
-                    else:
-                        self.logger.error("Error parsing SOCKS5 bind address")
-                        return False
-                    # no clue which order but does not matter anyways
-                    port = ord(chunk[pos]) << 8 & ord(chunk[pos+1])
-                    pos += 2
-                    
-                    reply = chunk[:pos]
-                    chunk = chunk[pos:]
-                    read_reply = False
-                f.write(chunk)
-                bytesread += len(chunk)
-                #self.logger.debug(f'read {bytesread}/{filesize} bytes')
-            self.logger.debug(f"Reply: read {bytesread}/{filesize} bytes")
-            self.logger.debug(f"SOCKS5 reply: {repr(reply)}")
-            f.close()
-            destfile = os.path.join(downloaddir,os.path.basename(self.filename))
-            self.logger.info(f"Download complete: {destfile}")
-            shutil.copyfile(fpath,destfile)
-            os.remove(fpath)
-            return True
-        except socket.error as e:
-            self.logger.debug(f"{e}")
-        return False
+                partial.write(bytesread, view[:nbytes])
+                bytesread += nbytes
+                self.received = bytesread
+            self.logger.debug(f"read {bytesread}/{filesize} bytes")
+            if self.cancelled:
+                self.logger.info(f"Transfer of {self.filename} cancelled")
+                self._interrupted(partial)
+                return False
+            if bytesread < filesize:
+                self.logger.error(
+                    f"Transfer of {self.filename} incomplete,"
+                    f" {bytesread}/{filesize} bytes"
+                )
+                self._interrupted(partial)
+                return False
+            self.sha256 = partial.finish()
+        except:
+            self._interrupted(partial)
+            raise
+        self.logger.info(
+            f"Download complete: {destfile}, sha256 {self.sha256}"
+        )
+        return True
+
+# partial file of an SI file offer; the offer and the transfer that
+# follows it find the same one
+def si_partial(destfile, other, filename, filesize, logger):
+    source = f"xmpp:{other.split('/')[0]}?file={filename}"
+    return PartialFile(destfile, source, filesize, logger)
 
 # out-of-band data transfer
 class Transfer_OOB(Transfer):
@@ -232,10 +447,10 @@ class Transfer_OOB(Transfer):
         # optional variable iq_id to differentiate between iq and x OOB
         self.__dict__['iq_id'] = ''
         
-    def retrieve(self, clientsocket, downloaddir):
+    def retrieve(self, clientsocket, downloaddir, options={}):
         if not self._is_valid():
             return False
-        status = self._get_file_oob(downloaddir)
+        status = self._get_file_oob(downloaddir, options)
         if len(self.iq_id):
             if status:
                 self._send_iq_oob_success(clientsocket)
@@ -248,38 +463,48 @@ class Transfer_OOB(Transfer):
         if len(self.iq_id):
             self._send_iq_oob_failure(clientsocket,406)
         
-    def _get_file_oob(self, downloaddir):
+    def _get_file_oob(self, downloaddir, options):
         self.logger.debug(
             f'retrieving file {self.filename}, size {self.filesize} bytes'
         )
-        fd, fpath = tempfile.mkstemp()
-        f = os.fdopen(fd, "wb")
-        self.logger.debug(f'Writing to "{fpath}"')
-        bytesread = 0
-        filesize = int(self.filesize)
+        name = urllib.parse.unquote(
+            urllib.parse.urlsplit(self.filename).path
+        )
+        destfile = self._destination(downloaddir, name)
+        if not destfile:
+            return False
+        # kept across attempts, resumed with range requests
+        partial = PartialFile(destfile, self.filename, logger=self.logger)
+        self.logger.debug(f'Writing to "{partial.path}"')
+        def progress(nbytes):
+            self.received += nbytes
+        downloader = HttpDownloader(
+            self.filename, partial,
+            segments=options.get('segments', 4),
+            timeout=options.get('timeout', 30),
+            logger=self.logger, progress=progress,
+            cancelled=lambda: self.cancelled
+        )
         try:
-            infile = urlopen(self.filename)
-            while bytesread < filesize:
-                chunk = infile.read(2048)
-                if not len(chunk):
-                    break
-                f.write(chunk)
-                bytesread += len(chunk)
-                #self.logger.debug(f"read {bytesread}/{filesize} bytes")
-        except:
-            raise
-        self.logger.debug(f"read {bytesread}/{filesize} bytes")
-        f.close()
-        destfile = os.path.join(downloaddir,os.path.basename(self.filename))
-        shutil.copyfile(fpath,destfile)
-        os.remove(fpath)
+            nbytes = downloader.run()
+            self.sha256 = partial.finish()
+        except (DownloadError, OSError) as e:
+            if self.cancelled:
+                self.logger.info(f"Transfer of {self.filename} cancelled")
+            else:
+                self.logger.error(f"Download of {self.filename} failed: {e}")
+            self._interrupted(partial)
+            return False
+        self.logger.debug(f"read {nbytes}/{self.filesize} bytes")
+        self.logger.info(
+            f"Download complete: {destfile}, sha256 {self.sha256}"
+        )
         return True
 
     def _send_iq_oob_success(self, cs):
-        cs.send(
-            f"<iq type='result' from='{self.identity}' to='{self.other}'"
-            f" id='{self.iq_id}'/>"
-        )
+        cs.send_bytes(stanza.IQ_RESULT.render(
+            identity=self.identity, other=self.other, id=self.iq_id
+        ))
     
     def _send_iq_oob_failure(self,cs,errorcode):
         if errorcode == 406:
@@ -290,10 +515,7 @@ class Transfer_OOB(Transfer):
             errortype = 'cancel'
             tag = 'item-not-found'
         
-        cs.send(
-            f"<iq type='error' from='{self.identity}' to='{self.other}'"
-            f" id='{self.iq_id}'/><query xmlns='jabber:iq:oob'>"
-            f"<url>{self.filename}</url></query>"
-            f"<error code='{errorcode}' type='{errortype}'>"
-            f"<{tag} xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error></iq>"
-        )
+        cs.send_bytes(stanza.OOB_ERROR.render(
+            identity=self.identity, other=self.other, id=self.iq_id,
+            url=self.filename, code=errorcode, type=errortype, condition=tag
+        ))
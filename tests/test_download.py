@@ -0,0 +1,113 @@
+import hashlib
+import http.server
+import logging
+import os
+import re
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from presence import download
+from presence.download import HttpDownloader
+from presence.partial  import PartialFile
+
+DATA = os.urandom(200000)
+
+# serves DATA at any path; honours byte ranges unless the server's
+# ranges flag is cleared, and records the Range header of every GET
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._headers(200, len(DATA))
+
+    def do_GET(self):
+        header = self.headers.get('Range', None)
+        self.server.requested.append(header)
+        match = re.fullmatch(r'bytes=(\d+)-(\d+)', header or '')
+        if not match or not self.server.ranges:
+            self._headers(200, len(DATA))
+            self.wfile.write(DATA)
+            return
+        start, end = int(match.group(1)), int(match.group(2)) + 1
+        self._headers(206, end - start, start)
+        self.wfile.write(DATA[start:end])
+
+    def log_message(self, format, *args):
+        pass
+
+    def _headers(self, status, length, start=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        if start is not None:
+            self.send_header(
+                'Content-Range', f'bytes {start}-{start+length-1}/{len(DATA)}'
+            )
+        self.end_headers()
+
+class HttpDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), RangeHandler
+        )
+        self.server.daemon_threads = True
+        self.server.ranges    = True
+        self.server.requested = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/file'
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.destfile = os.path.join(self.tmp.name, 'file')
+        self.logger   = logging.getLogger('test')
+
+        # small segments, so that DATA is split
+        patcher = mock.patch.object(download, 'MINSEGMENT', 16384)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def download(self, partial):
+        nbytes = HttpDownloader(
+            self.url, partial, segments=4, timeout=5, logger=self.logger
+        ).run()
+        checksum = partial.finish()
+        self.assertEqual(nbytes, len(DATA))
+        self.assertEqual(checksum, hashlib.sha256(DATA).hexdigest())
+        with open(self.destfile, 'rb') as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertEqual(os.listdir(self.tmp.name), ['file'])
+
+    def test_segments(self):
+        self.download(PartialFile(self.destfile, self.url, logger=self.logger))
+        self.assertEqual(len(self.server.requested), 4)
+        self.assertTrue(all(self.server.requested))
+
+    def test_ranges_ignored(self):
+        self.server.ranges = False
+        self.download(PartialFile(self.destfile, self.url, logger=self.logger))
+        # the whole file is fetched once more without a range
+        self.assertIn(None, self.server.requested)
+
+    def test_resume(self):
+        kept = 120000
+        partial = PartialFile(
+            self.destfile, self.url, size=len(DATA), logger=self.logger
+        )
+        partial.open()
+        partial.write(0, DATA[:kept])
+        partial.close()
+
+        self.download(PartialFile(self.destfile, self.url, logger=self.logger))
+        self.assertTrue(len(self.server.requested))
+        for header in self.server.requested:
+            start = int(re.match(r'bytes=(\d+)-', header).group(1))
+            self.assertGreaterEqual(start, kept)
+
+if __name__ == '__main__':
+    unittest.main()